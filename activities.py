@@ -0,0 +1,66 @@
+# Kept apart from the scheduler so that the CLI can validate activity names
+# without importing selenium
+from helpers import format_date_time, parse_date_time_string
+
+
+class Activities:
+    CROSSFIT = 'Crossfit'
+    TRX = 'Trx'
+    FREESTYLE = 'Freestyle'
+    METABOLIC = 'Metabolic'
+    PILATES = 'Pilates'
+    YOGA = 'Yoga'
+    XTREME = 'Xtreme'
+    INSANITY = 'Insanity'
+
+
+class Activity(object):
+    '''
+    A class with a given name starting at a given datetime.
+
+    Immutable and hashable so it can be used as a key when matching what the
+    user asked for against what is on the site. Names are compared case
+    insensitively, like the site does.
+    '''
+
+    __slots__ = ('name', 'date_time', '_key')
+
+    def __init__(self, name, date_time):
+        object.__setattr__(self, 'name', name)
+        object.__setattr__(self, 'date_time', date_time)
+        object.__setattr__(self, '_key', (name.lower(), date_time))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Activity is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('Activity is immutable')
+
+    def __reduce__(self):
+        return Activity, (self.name, self.date_time)
+
+    def __eq__(self, other):
+        return isinstance(other, Activity) and self._key == other._key
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._key)
+
+    def __repr__(self):
+        return 'Activity({!r}, {!r})'.format(self.name, self.date_time)
+
+    def __str__(self):
+        return '{} on {:%Y-%m-%d} at {:%H:%M}'.format(
+            self.name, self.date_time, self.date_time)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['activity'], parse_date_time_string(data['date_time']))
+
+    def to_dict(self):
+        return {
+            'activity': self.name,
+            'date_time': format_date_time(self.date_time),
+        }
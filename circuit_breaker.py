@@ -0,0 +1,151 @@
+import os
+import math
+import time
+import logging
+import contextlib
+
+import settings
+from helpers import locked_json_file, read_locked_json_file
+
+
+_DEFAULT_STATE_FILE = os.path.join(
+    os.getenv('HOME'), '.gym_sub', 'circuit.json')
+
+
+class CircuitOpenError(ValueError):
+    pass
+
+
+class _GuardedCall(object):
+
+    def __init__(self):
+        self.failed = False
+
+    def fail(self):
+        '''
+        Count the call as a failure even though it returns normally, e.g.
+        when the site timed out partway through a batch
+        '''
+        self.failed = True
+
+
+class CircuitBreaker(object):
+    '''
+    Stops talking to the site after `failure_threshold` consecutive failures.
+
+    While open every call fails fast with CircuitOpenError. After
+    `reset_timeout` seconds a single caller is let through (half open); if it
+    succeeds the circuit closes, otherwise it opens again.
+
+    The state lives in a file so that it is shared by the slack bot and every
+    `gym_sub` process it spawns.
+    '''
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, state_file=None, failure_threshold=None,
+                 reset_timeout=None, failure_exceptions=(Exception,)):
+        self._state_file = state_file or _DEFAULT_STATE_FILE
+        self._failure_threshold = (
+            failure_threshold or settings.CIRCUIT_FAILURE_THRESHOLD)
+        self._reset_timeout = reset_timeout or settings.CIRCUIT_RESET_TIMEOUT
+        self._failure_exceptions = failure_exceptions
+
+    @staticmethod
+    def _initial_state():
+        return {
+            'state': CircuitBreaker.CLOSED,
+            'failures': 0,
+            'opened_at': None,
+            'probe_started_at': None,
+        }
+
+    def _locked_state(self):
+        return locked_json_file(self._state_file, self._initial_state)
+
+    def _open_error(self, state, now):
+        retry_in = int(math.ceil(
+            self._reset_timeout - (now - state['opened_at'])))
+        return CircuitOpenError(
+            'The gym site is failing, not trying again for {} seconds'
+            .format(max(retry_in, 0)))
+
+    def get_state(self):
+        # Read only, this is polled by the bot every second
+        return read_locked_json_file(self._state_file, self._initial_state)
+
+    def raise_if_open(self):
+        '''
+        Fail fast without claiming the half open probe. Useful before doing
+        expensive work such as starting a driver.
+        '''
+        now = time.time()
+        state = self.get_state()
+        if (state['state'] == self.OPEN and
+                now - state['opened_at'] < self._reset_timeout):
+            raise self._open_error(state, now)
+
+    def before_call(self):
+        now = time.time()
+        with self._locked_state() as state:
+            if state['state'] == self.CLOSED:
+                return
+
+            if state['state'] == self.OPEN:
+                if now - state['opened_at'] < self._reset_timeout:
+                    raise self._open_error(state, now)
+
+                logging.info('Circuit half open, probing the site')
+                state['state'] = self.HALF_OPEN
+                state['probe_started_at'] = now
+                return
+
+            # Half open. Only one probe at a time, unless the last one
+            # never reported back.
+            probe_started_at = state['probe_started_at'] or 0
+            if now - probe_started_at < self._reset_timeout:
+                raise CircuitOpenError(
+                    'The gym site is being probed, try again later')
+
+            state['probe_started_at'] = now
+
+    def record_success(self):
+        with self._locked_state() as state:
+            if state['state'] != self.CLOSED:
+                logging.info('Circuit closed')
+
+            state.update(self._initial_state())
+
+    def record_failure(self):
+        with self._locked_state() as state:
+            state['failures'] += 1
+
+            if (state['state'] == self.HALF_OPEN or
+                    state['failures'] >= self._failure_threshold):
+                logging.error(
+                    'Circuit open after {} failures'.format(state['failures']))
+                state['state'] = self.OPEN
+                state['opened_at'] = time.time()
+                state['probe_started_at'] = None
+
+    @contextlib.contextmanager
+    def guard(self):
+        self.before_call()
+
+        call = _GuardedCall()
+        try:
+            yield call
+        except self._failure_exceptions:
+            self.record_failure()
+            raise
+        except Exception:
+            # The site answered, we just did not like the answer
+            self.record_success()
+            raise
+        else:
+            if call.failed:
+                self.record_failure()
+            else:
+                self.record_success()
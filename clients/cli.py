@@ -1,11 +1,14 @@
 import click
 
 from commands import (
-    schedule_activity, save_activity, cancel_schedule,
+    schedule_activity, save_activity, cancel_many,
     create_from_storage as create_from_store, get_active_schedules,
-    get_pending_activities, cancel_pending_schedule)
-from scheduler import CrossfitScheduler
-from helpers import parse_date_time_string
+    get_pending_activities, cancel_pending_schedule,
+    schedule_first_available)
+from activities import Activities, Activity
+from circuit_breaker import CircuitBreaker
+from driver_supervisor import get_supervisor
+from helpers import configure_logging, parse_date_time_string
 
 
 class DateTimeParamType(click.ParamType):
@@ -23,14 +26,14 @@ class DateTimeParamType(click.ParamType):
 class ClassParamType(click.ParamType):
     name = 'class'
     _allowed_values = (
-        CrossfitScheduler.Activities.CROSSFIT,
-        CrossfitScheduler.Activities.FREESTYLE,
-        CrossfitScheduler.Activities.METABOLIC,
-        CrossfitScheduler.Activities.PILATES,
-        CrossfitScheduler.Activities.TRX,
-        CrossfitScheduler.Activities.YOGA,
-        CrossfitScheduler.Activities.XTREME,
-        CrossfitScheduler.Activities.INSANITY,
+        Activities.CROSSFIT,
+        Activities.FREESTYLE,
+        Activities.METABOLIC,
+        Activities.PILATES,
+        Activities.TRX,
+        Activities.YOGA,
+        Activities.XTREME,
+        Activities.INSANITY,
     )
 
     def convert(self, value, param, ctx):
@@ -42,15 +45,118 @@ class ClassParamType(click.ParamType):
         return value
 
 
+# Name of the command that runs, e.g. gym_schedule-create, to name profiles
+_COMMAND_NAME_KEY = 'gym_sub.command_name'
+
+
 @click.group()
-def cli():
-    pass
+@click.option('--profile/--no-profile', default=False,
+              help='Profile the command and write the results to PROFILES_DIR')
+@click.pass_context
+def cli(ctx, profile):
+    configure_logging()
+
+    if profile:
+        _start_profiling(ctx)
+
+
+def _start_profiling(ctx):
+    import settings
+    from profiling import Profiler, make_profile_prefix
+
+    profiler = Profiler()
+
+    def write_profile():
+        profiler.stop()
+        # Groups put the name of their subcommand in there
+        name = ctx.meta.get(
+            _COMMAND_NAME_KEY, ctx.invoked_subcommand or 'gym_sub')
+        paths = profiler.dump(
+            make_profile_prefix(settings.PROFILES_DIR, name))
+        click.echo('Profile written to {}'.format(', '.join(paths)), err=True)
+
+    profiler.start()
+    ctx.call_on_close(write_profile)
+
+
+@cli.command()
+def site_status():
+    '''Show whether we are currently talking to the gym site'''
+    state = CircuitBreaker().get_state()
+
+    click.echo('Gym site circuit is {} ({} consecutive failures)'.format(
+        state['state'], state['failures']))
+
+
+@cli.command()
+@click.option('--reap/--no-reap', default=False,
+              help='Kill leaked browser drivers before reporting')
+def driver_status(reap):
+    '''Show the browser drivers running on this host'''
+    supervisor = get_supervisor()
+
+    if reap:
+        click.echo('Killed {} leaked drivers'.format(supervisor.reap()))
+
+    stats = supervisor.get_stats()
+    click.echo('{} live drivers using {:.1f} MB'.format(
+        stats['live_drivers'], stats['rss'] / 1024.0 / 1024.0))
+
+
+@cli.command()
+@click.argument('recording', type=click.Path(exists=True, readable=True))
+@click.option('--speed', type=click.FLOAT, default=1.0,
+              help=('Multiplier for the recorded delays. '
+                    '0 replays as fast as possible'))
+def replay(recording, speed):
+    '''Replay a recorded scheduler session offline'''
+    from replay import replay as replay_recording
+
+    try:
+        results = replay_recording(recording, speed=speed)
+    except Exception, e:
+        click.echo('Failed with reason: {}'.format(e), err=True)
+        raise click.Abort()
+
+    for name, result, elapsed in results:
+        click.echo('{} returned {!r} in {:.3f}s'.format(name, result, elapsed))
+
+
+@cli.command()
+def fill_rates():
+    '''Show how fast each class usually gets full'''
+    from fill_history import FillHistory, format_duration
+
+    weekdays = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+    typical = FillHistory().get_typical_time_to_full()
+
+    # Fastest first, those are the ones worth trying early for
+    for slot, seconds in sorted(typical.items(), key=lambda item: item[1]):
+        name, weekday, (hour, minute) = slot
+        click.echo('{} on {} at {:02d}:{:02d} gets full in {}'.format(
+            name, weekdays[weekday], hour, minute, format_duration(seconds)))
+
+
+@cli.command()
+@click.option('--port', type=click.INT, default=None,
+              help='Port to listen on, on localhost')
+@click.option('--interval', type=click.INT, default=None,
+              help='Seconds between two scrapes of the timetable')
+def serve_timetable(port, interval):
+    '''Scrape the timetable once for everybody and serve it'''
+    import settings
+    from timetable_service import TimetableService
+
+    TimetableService(refresh_interval=interval).serve_forever(
+        port or settings.TIMETABLE_SERVICE_PORT)
 
 
 @cli.group()
-def gym_schedule():
+@click.pass_context
+def gym_schedule(ctx):
     '''Manage registrations'''
-    pass
+    ctx.meta[_COMMAND_NAME_KEY] = '{}-{}'.format(
+        ctx.info_name, ctx.invoked_subcommand)
 
 
 @gym_schedule.command()
@@ -67,31 +173,72 @@ def gym_schedule():
               type=click.Path(writable=True, readable=True),
               help=('File for saving inactive activities. '
                     'Defaults to home directory'))
-def create(email, activity, date, store_if_not_active, storage_file):
+@click.option('--first-available/--in-order', default=False,
+              help=('Try all the dates at the same time and keep the first '
+                    'one that gets scheduled instead of trying them one by '
+                    'one'))
+def create(email, activity, date, store_if_not_active, storage_file,
+           first_available):
     '''Register for a class'''
+    if first_available:
+        _create_first_available(
+            email, [Activity(activity, date_time) for date_time in date],
+            store_if_not_active, storage_file)
+        return
+
     for date_time in date:
+        target = Activity(activity, date_time)
         try:
-            was_scheduled = schedule_activity(
-                email, activity, date_time.date, date_time.time)
+            was_scheduled = schedule_activity(email, target)
         except Exception, e:
             click.echo('Failed with reason: {}'.format(e), err=True)
             raise click.Abort()
 
         if was_scheduled:
-            click.echo('Scheduled you for {} on {} at {}:{}'.format(
-                activity, date_time.date, *date_time.time))
+            click.echo('Scheduled you for {}'.format(target))
             exit(0)
         else:
-            click.echo(
-                'Could not schedule you for {} on {} at {}:{}. '
-                .format(activity, date_time.date, *date_time.time))
+            click.echo('Could not schedule you for {}. '.format(target))
+
+            if store_if_not_active:
+                save_activity(email, target, storage_file=storage_file)
+                click.echo(
+                    'The activity details were saved. You can try again '
+                    'later by running command run_from_storage')
+
+
+def _create_first_available(email, targets, store_if_not_active, storage_file):
+    def report_scheduled(target):
+        click.echo('Scheduled you for {}'.format(target))
+
+    results = schedule_first_available(
+        email, targets, on_scheduled=report_scheduled)
+
+    statuses = [status for _, status, _ in results]
+    for target, status, error in results:
+        if status == 'cancelled':
+            click.echo('Also got {}, cancelled it'.format(target))
+        elif status == 'cancel_failed':
+            click.echo('Also got {} but could not cancel it: {}'.format(
+                target, error), err=True)
+        elif status == 'failed':
+            click.echo('Could not schedule you for {}: {}'.format(
+                target, error), err=True)
+        elif status == 'not_visible' and 'scheduled' not in statuses:
+            click.echo('Could not schedule you for {}. '.format(target))
 
             if store_if_not_active:
-                save_activity(email, activity, date_time.date, date_time.time)
+                save_activity(email, target, storage_file=storage_file)
                 click.echo(
                     'The activity details were saved. You can try again '
                     'later by running command run_from_storage')
 
+    if 'scheduled' in statuses:
+        exit(1 if 'cancel_failed' in statuses else 0)
+
+    if 'failed' in statuses:
+        raise click.Abort()
+
 
 @gym_schedule.command()
 @click.option('--email', type=click.STRING, required=True,
@@ -103,22 +250,24 @@ def create(email, activity, date, store_if_not_active, storage_file):
 def cancel(email, activity, date):
     '''Cancel a registration'''
 
-    with CrossfitScheduler(email) as scheduler:
-        for date_time in date:
-            try:
-                was_cancelled = scheduler.cancel_schedule(
-                        activity, date_time.date, date_time.time)
-            except Exception, e:
-                click.echo('Failed with reason: {}'.format(e), err=True)
-                raise click.Abort()
-
-            if was_cancelled:
-                click.echo('Canceled schedule for {} on {} at {}:{}'.format(
-                    activity, date_time.date, *date_time.time))
-            else:
-                click.echo(
-                    'Could not cancel schedule for {} on {} at {}:{}'.format(
-                        activity, date_time.date, *date_time.time))
+    targets = [Activity(activity, date_time) for date_time in date]
+    try:
+        results = cancel_many(email, targets)
+    except Exception, e:
+        click.echo('Failed with reason: {}'.format(e), err=True)
+        raise click.Abort()
+
+    failed = False
+    for target, error in results:
+        if error is None:
+            click.echo('Canceled schedule for {}'.format(target))
+        else:
+            failed = True
+            click.echo('Could not cancel schedule for {}: {}'.format(
+                target, error), err=True)
+
+    if failed:
+        raise click.Abort()
 
 
 @gym_schedule.command()
@@ -134,28 +283,30 @@ def create_from_storage(storage_file):
         click.echo('Failed with reason: {}'.format(e), err=True)
         raise click.Abort()
 
-    for schedule in scheduled:
-        click.echo('Scheduled {} for {} on {} at {}:{}'.format(
-            schedule['email'], schedule['activity'], schedule['date'],
-            *schedule['time'])
-        )
+    for email, activity, error in scheduled:
+        if error:
+            click.echo('Could not schedule {} for {}: {}'.format(
+                email, activity, error))
+        else:
+            click.echo('Scheduled {} for {}'.format(email, activity))
 
 
 @gym_schedule.command()
 @click.option('--email', type=click.STRING, required=True,
               help='Email address for the registration')
-def list_active(email):
+@click.option('--refresh/--cached', default=False,
+              help='Read the schedules from the site instead of the cache')
+def list_active(email, refresh):
     '''List active schedules'''
 
     try:
-        schedules = get_active_schedules(email)
+        schedules = get_active_schedules(email, force_refresh=refresh)
     except Exception, e:
         click.echo('Failed with reason: {}'.format(e), err=True)
         raise click.Abort()
 
     for schedule in schedules:
-        click.echo('Active schedule for {} on {} at {}:{}'.format(
-            schedule['activity'], schedule['date'], *schedule['time']))
+        click.echo('Active schedule for {}'.format(schedule))
 
 
 @gym_schedule.command()
@@ -174,8 +325,7 @@ def list_pending(email, storage_file):
         raise click.Abort()
 
     for activity in activities:
-        click.echo('Pending activity for {} on {} at {}:{}'.format(
-            activity['activity'], activity['date'], *activity['time']))
+        click.echo('Pending activity for {}'.format(activity))
 
 
 @gym_schedule.command()
@@ -192,12 +342,11 @@ def list_pending(email, storage_file):
 def cancel_pending(email, activity, date, storage_file):
     '''Cancel pending activity'''
     for date_time in date:
+        target = Activity(activity, date_time)
         try:
-            cancel_pending_schedule(
-                email, activity, date_time.date, date_time.time)
+            cancel_pending_schedule(email, target, storage_file=storage_file)
         except Exception, e:
             click.echo('Failed with reason: {}'.format(e), err=True)
             raise click.Abort()
 
-        click.echo('Canceled pending activity for {} on {} at {}:{}'.format(
-            activity, date_time.date, *date_time.time))
+        click.echo('Canceled pending activity for {}'.format(target))
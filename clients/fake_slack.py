@@ -0,0 +1,132 @@
+'''
+An in-memory Slack workspace that stands in for SlackClient, to run the bot
+without a network.
+
+It answers the Web API methods the bot uses (users.list, im.open,
+channels.info and chat.postMessage) and hands out the messages sent with
+`send_message` as RTM events.
+'''
+import time
+import threading
+from collections import deque
+
+
+class FakeSlack(object):
+
+    GENERAL_CHANNEL = 'C00000000'
+
+    def __init__(self, users=10, bot_name='schedule_keeper', api_latency=0,
+                 on_post=None):
+        '''
+        ** users
+            Number of members in the workspace, besides the bot
+        ** api_latency
+            Seconds every Web API call takes, like a round trip to Slack
+        ** on_post
+            Called with (channel, text) for every chat.postMessage
+        '''
+        self.token = 'xoxb-fake'
+        self._api_latency = api_latency
+        self._on_post = on_post
+        self._lock = threading.Lock()
+        self._events = deque()
+
+        self.bot_id = 'UBOT00000'
+        self.members = [{
+            'id': self.bot_id,
+            'name': bot_name,
+            'profile': {},
+        }]
+        for index in range(users):
+            self.members.append({
+                'id': 'U{:08d}'.format(index),
+                'name': 'user{}'.format(index),
+                'profile': {'email': 'user{}@example.com'.format(index)},
+            })
+
+        self.call_counts = {}
+        self.posted = []
+
+        self._handlers = {
+            'users.list': self._users_list,
+            'im.open': self._im_open,
+            'channels.info': self._channels_info,
+            'chat.postMessage': self._chat_post_message,
+        }
+
+    @property
+    def user_ids(self):
+        return [
+            member['id'] for member in self.members
+            if member['id'] != self.bot_id
+        ]
+
+    @staticmethod
+    def get_im_channel(user_id):
+        return 'D' + user_id[1:]
+
+    def _users_list(self):
+        return {'ok': True, 'members': self.members}
+
+    def _im_open(self, user):
+        return {'ok': True, 'channel': {'id': self.get_im_channel(user)}}
+
+    def _channels_info(self, channel):
+        # Like Slack, only public channels are found, not ims
+        if channel != self.GENERAL_CHANNEL:
+            return {'ok': False, 'error': 'channel_not_found'}
+
+        return {'ok': True, 'channel': {'id': channel, 'is_general': True}}
+
+    def _chat_post_message(self, channel, text, as_user=False):
+        with self._lock:
+            self.posted.append((time.time(), channel, text))
+            # RTM sends our own messages back to us too
+            self._events.append(
+                self._make_event(self.bot_id, channel, text))
+
+        if self._on_post is not None:
+            self._on_post(channel, text)
+
+        return {'ok': True, 'channel': channel, 'ts': str(time.time())}
+
+    def api_call(self, method, **kwargs):
+        with self._lock:
+            self.call_counts[method] = self.call_counts.get(method, 0) + 1
+
+        if self._api_latency:
+            time.sleep(self._api_latency)
+
+        if method not in self._handlers:
+            return {'ok': False, 'error': 'unknown_method'}
+
+        return self._handlers[method](**kwargs)
+
+    def rtm_connect(self):
+        return True
+
+    def rtm_read(self):
+        events = []
+        with self._lock:
+            while self._events:
+                events.append(self._events.popleft())
+
+        return events
+
+    @staticmethod
+    def _make_event(user_id, channel, text):
+        return {
+            'type': 'message',
+            'user': user_id,
+            'channel': channel,
+            'text': text,
+            'ts': str(time.time()),
+        }
+
+    def send_message(self, user_id, text):
+        '''
+        Queue a direct message from the user to the bot
+        '''
+        with self._lock:
+            self._events.append(self._make_event(
+                user_id, self.get_im_channel(user_id), text))
@@ -0,0 +1,189 @@
+'''
+Minimal Prometheus metrics for the slack bot, served as text over HTTP from a
+daemon thread.
+'''
+import threading
+import logging
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+
+_DEFAULT_BUCKETS = (
+    0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, float('inf'))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+
+    return '{' + ','.join(
+        '{}="{}"'.format(key, str(value).replace('"', '\\"'))
+        for key, value in sorted(labels.items())
+    ) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value))
+
+
+class _Metric(object):
+    type_ = None
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._lock = threading.Lock()
+
+    def samples(self):
+        '''
+        Return a list of (name suffix, labels, value)
+        '''
+        raise NotImplementedError
+
+    def render(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.help_text),
+            '# TYPE {} {}'.format(self.name, self.type_),
+        ]
+        for suffix, labels, value in self.samples():
+            lines.append('{}{}{} {}'.format(
+                self.name, suffix, _format_labels(labels),
+                _format_value(value)))
+
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    type_ = 'counter'
+
+    def __init__(self, name, help_text):
+        super(Counter, self).__init__(name, help_text)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [
+                ('', dict(key), value) for key, value in self._values.items()]
+
+
+class Gauge(_Metric):
+    type_ = 'gauge'
+
+    def __init__(self, name, help_text, function=None):
+        super(Gauge, self).__init__(name, help_text)
+        self._value = 0
+        self._function = function
+
+    def set(self, value):
+        with self._lock:
+            self._value = value
+
+    def samples(self):
+        if self._function is not None:
+            return [('', {}, self._function())]
+
+        with self._lock:
+            return [('', {}, self._value)]
+
+
+class Histogram(_Metric):
+    type_ = 'histogram'
+
+    def __init__(self, name, help_text, buckets=_DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help_text)
+        self._buckets = buckets
+        self._counts = [0] * len(buckets)
+        self._sum = 0.0
+        self._count = 0
+
+    def observe(self, value):
+        with self._lock:
+            self._sum += value
+            self._count += 1
+            for index, bound in enumerate(self._buckets):
+                if value <= bound:
+                    self._counts[index] += 1
+
+    def samples(self):
+        with self._lock:
+            samples = [
+                ('_bucket', {'le': _format_value(bound)}, count)
+                for bound, count in zip(self._buckets, self._counts)
+            ]
+            samples.append(('_sum', {}, self._sum))
+            samples.append(('_count', {}, self._count))
+
+        return samples
+
+
+class CallbackMetric(_Metric):
+    '''
+    A metric whose labelled values are read at scrape time from `function`,
+    which returns a list of (labels, value) tuples.
+    '''
+
+    def __init__(self, name, help_text, type_, function):
+        super(CallbackMetric, self).__init__(name, help_text)
+        self.type_ = type_
+        self._function = function
+
+    def samples(self):
+        return [('', labels, value) for labels, value in self._function()]
+
+
+class Registry(object):
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        rendered = []
+        for metric in self._metrics:
+            try:
+                rendered.append(metric.render())
+            except Exception, e:
+                # One broken collector should not hide all the others
+                logging.error('Could not collect metric {}: {}'.format(
+                    metric.name, e))
+
+        return '\n'.join(rendered) + '\n'
+
+
+def start_server(registry, port, host='127.0.0.1'):
+    class MetricsHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+
+            body = registry.render()
+            self.send_response(200)
+            self.send_header(
+                'Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = HTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    logging.info('Serving metrics on {}:{}'.format(host, port))
+
+    return server
@@ -1,3 +1,4 @@
+import os
 import re
 import time
 import datetime
@@ -8,11 +9,68 @@ from subprocess import Popen, PIPE, STDOUT
 from slackclient import SlackClient
 
 import settings
+from clients.metrics import (
+    CallbackMetric, Counter, Gauge, Histogram, Registry, start_server)
+from clients.slack_outbox import Outbox, RateLimitedSlackApi
+from circuit_breaker import CircuitBreaker
+from driver_supervisor import get_supervisor
+from helpers import configure_logging
+from memory_diagnostics import MemoryDiagnostics, write_report
+from profiling import Profiler, make_profile_prefix
+from site_rate_limiter import get_rate_limiter
 from commands import (
-    create_from_storage, get_active_schedules, get_pending_activities)
-
-
-sc = SlackClient(settings.SLACK_TOKEN)
+    create_from_storage, get_active_schedules, get_pending_activities,
+    get_storage_stats, refresh_stale_active_schedules)
+
+
+# Set by `configure`
+sc = None
+slack_api = None
+outbox = None
+
+registry = Registry()
+_LOOP_LAG = registry.register(Gauge(
+    'gym_bot_loop_lag_seconds',
+    'Time the last loop iteration took on top of its one second sleep'))
+_DO_STUFF_SECONDS = registry.register(Histogram(
+    'gym_bot_do_stuff_seconds', 'Time spent in the periodic jobs'))
+_PROCESS_MESSAGE_SECONDS = registry.register(Histogram(
+    'gym_bot_process_message_seconds', 'Time spent answering a message'))
+_BOOKINGS = registry.register(Counter(
+    'gym_bot_bookings_total',
+    'Attempts to book stored activities by activity and outcome'))
+registry.register(CallbackMetric(
+    'gym_bot_slack_api_calls_total', 'Slack Web API calls by method',
+    'counter',
+    lambda: [({'method': method}, count)
+             for method, count in slack_api.call_counts.items()]))
+registry.register(CallbackMetric(
+    'gym_bot_slack_api_errors_total',
+    'Slack Web API calls that were not ok by method', 'counter',
+    lambda: [({'method': method}, count)
+             for method, count in slack_api.error_counts.items()]))
+registry.register(Gauge(
+    'gym_live_drivers', 'Browser drivers running on this host',
+    function=lambda: get_supervisor().get_stats()['live_drivers']))
+registry.register(Gauge(
+    'gym_live_drivers_rss_bytes', 'Memory used by the running drivers',
+    function=lambda: get_supervisor().get_stats()['rss']))
+registry.register(CallbackMetric(
+    'gym_site_requests_total',
+    'Requests made to the gym site by kind (read or booking)', 'counter',
+    lambda: [({'kind': kind}, stats['acquired'])
+             for kind, stats in get_rate_limiter().get_stats().items()]))
+registry.register(CallbackMetric(
+    'gym_site_rate_limit_wait_seconds_total',
+    'Time spent waiting for the site rate limiter by kind', 'counter',
+    lambda: [({'kind': kind}, stats['waited'])
+             for kind, stats in get_rate_limiter().get_stats().items()]))
+registry.register(Gauge(
+    'gym_storage_entries', 'Activities waiting in storage',
+    function=lambda: get_storage_stats()['entries']))
+registry.register(Gauge(
+    'gym_storage_bytes', 'Size of the storage file',
+    function=lambda: get_storage_stats()['bytes']))
 
 
 def raise_if_not_ok(response):
@@ -24,7 +82,7 @@ def get_user_id_by_email(email):
     def email_filter(user):
         return 'email' in user['profile'] and user['profile']['email'] == email
 
-    users_response = sc.api_call('users.list')
+    users_response = slack_api.api_call('users.list')
     raise_if_not_ok(users_response)
 
     users = users_response['members']
@@ -38,7 +96,7 @@ def get_user_id_by_email(email):
 
 
 def is_general_channel(channel):
-    result = sc.api_call('channels.info', channel=channel)
+    result = slack_api.api_call('channels.info', channel=channel)
 
     if result['ok'] is False:
         if result['error'] == 'channel_not_found':
@@ -50,7 +108,7 @@ def is_general_channel(channel):
 
 
 def get_user_id_by_name(name):
-    users_response = sc.api_call('users.list')
+    users_response = slack_api.api_call('users.list')
     raise_if_not_ok(users_response)
 
     users = users_response['members']
@@ -64,7 +122,7 @@ def get_user_id_by_name(name):
 
 
 def get_email_by_user_id(user_id):
-    users_response = sc.api_call('users.list')
+    users_response = slack_api.api_call('users.list')
     raise_if_not_ok(users_response)
 
     users = users_response['members']
@@ -78,7 +136,7 @@ def get_email_by_user_id(user_id):
 
 
 def get_chat_with_user(user_id):
-    chat_response = sc.api_call('im.open', user=user_id)
+    chat_response = slack_api.api_call('im.open', user=user_id)
     raise_if_not_ok(chat_response)
 
     return chat_response['channel']['id']
@@ -98,28 +156,129 @@ def normalize_message(message):
     return msg
 
 
+def run_gym_sub(arguments):
+    cmd = 'gym_sub {}'.format(arguments)
+
+    p = Popen(cmd, shell=True, close_fds=True, stdin=PIPE,
+              stdout=PIPE, stderr=STDOUT)
+
+    return p.stdout.read()
+
+
 def process_message(message):
     if message['type'] != 'message':
         return
 
-    cmd = 'gym_sub {}'.format(normalize_message(message['text']))
+    started_at = time.time()
 
-    p = Popen(cmd, shell=True, close_fds=True, stdin=PIPE,
-              stdout=PIPE, stderr=STDOUT)
-    output = p.stdout.read()
-    sc.api_call(
+    output = _COMMAND_RUNNER(normalize_message(message['text']))
+    slack_api.api_call(
         'chat.postMessage', channel=message['channel'], text=output,
         as_user=True)
 
+    _PROCESS_MESSAGE_SECONDS.observe(time.time() - started_at)
+
+
+# "profile do_stuff" profiles the next periodic jobs run and "profile <gym_sub
+# arguments>" runs the command with --profile, whose output says where the
+# profile is
+_PROFILE_MESSAGE_RE = re.compile(r'^profile\s+(?P<target>.+)$')
+_PROFILE_DO_STUFF_FOR = None
+
+
+def profile_call(name, channel, func, *args):
+    '''
+    Run func under the profiler and tell the channel where the profile is
+    '''
+    profiler = Profiler()
+    try:
+        with profiler.running():
+            func(*args)
+    finally:
+        paths = profiler.dump(
+            make_profile_prefix(settings.PROFILES_DIR, name))
+        slack_api.api_call(
+            'chat.postMessage', channel=channel,
+            text='Profile written to {}\n{}'.format(
+                ', '.join(paths), profiler.get_summary()),
+            as_user=True)
+
+
+def handle_message(message):
+    global _PROFILE_DO_STUFF_FOR
+
+    match = _PROFILE_MESSAGE_RE.match(message.get('text', '').strip())
+    if match is None:
+        process_message(message)
+        return
+
+    if get_email_by_user_id(message['user']) != settings.EMAIL:
+        slack_api.api_call(
+            'chat.postMessage', channel=message['channel'],
+            text='Only the owner of the bot can profile it', as_user=True)
+        return
+
+    if match.group('target') == 'do_stuff':
+        _PROFILE_DO_STUFF_FOR = message['channel']
+        return
+
+    # The bot only waits for the command, the work is in the child
+    process_message(
+        dict(message, text='--profile {}'.format(match.group('target'))))
+
 
 _BOT_NAME = 'schedule_keeper'
-_BOT_ID = get_user_id_by_name(_BOT_NAME)
+# Resolved on first use, see `get_bot_id`
+_BOT_ID = None
+
+_COMMAND_RUNNER = run_gym_sub
+_PERIODIC_JOBS_ENABLED = True
+
+
+def configure(client, command_runner=run_gym_sub, periodic_jobs=True):
+    '''
+    Set what the bot talks to. Must be called before `run`.
+
+    ** client
+        A SlackClient or anything with the same api_call, rtm_connect and
+        rtm_read methods
+    ** command_runner
+        Called with the gym_sub arguments of every message, returns the text
+        to answer with
+    ** periodic_jobs
+        Whether to run the periodic jobs (storage, reminders, ...) between
+        messages
+    '''
+    global sc, slack_api, outbox, _BOT_ID, _COMMAND_RUNNER
+    global _PERIODIC_JOBS_ENABLED
+
+    sc = client
+    slack_api = RateLimitedSlackApi(client)
+    outbox = Outbox(slack_api)
+    _BOT_ID = None
+    _COMMAND_RUNNER = command_runner
+    _PERIODIC_JOBS_ENABLED = periodic_jobs
+
+
+def get_bot_id():
+    global _BOT_ID
+
+    if _BOT_ID is None:
+        _BOT_ID = get_user_id_by_name(_BOT_NAME)
+
+    return _BOT_ID
+
 
 _STORAGE_LAST_TIME_CHECKED = None
 _SHOW_ACTIVITIES_LAST_TIME_CHECKED = None
+_REAP_DRIVERS_LAST_TIME_CHECKED = None
+_REFRESH_ACTIVE_SCHEDULES_LAST_TIME_CHECKED = None
+_MEMORY_DIAGNOSTICS_LAST_TIME_CHECKED = None
 # In minutes
 _STORAGE_CHECK_INTERVAL = 30
 _SHOW_SCHEDULED_AVTIVITIES_INTERVAL = 300
+_REAP_DRIVERS_INTERVAL = 5
+_REFRESH_ACTIVE_SCHEDULES_INTERVAL = 10
 
 
 def run_storage():
@@ -132,22 +291,20 @@ def run_storage():
 
     _STORAGE_LAST_TIME_CHECKED = datetime.datetime.now()
 
-    activities = create_from_storage()
+    def count_attempt(email, activity, outcome):
+        _BOOKINGS.inc(activity=activity.name, outcome=outcome)
 
-    for activity in activities:
-        user_id = get_user_id_by_email(activity['email'])
-        channel = get_chat_with_user(user_id)
+    activities = create_from_storage(on_attempt=count_attempt)
 
-        if activity.get('error'):
-            sc.api_call(
-                'chat.postMessage', channel=channel, text=activity['error'],
-                as_user=True)
+    for email, activity, error in activities:
+        if error:
+            # All of a user's results go in one message, say which is which
+            outbox.add(email, '{}: {}'.format(activity, error))
             continue
 
-        text = 'Scheduled you for {} on {} at {}:{}'.format(
-            activity['activity'], activity['date'], *activity['time'])
-        sc.api_call(
-            'chat.postMessage', channel=channel, text=text, as_user=True)
+        outbox.add(email, 'Scheduled you for {}'.format(activity))
+
+    outbox.flush(header='Results of trying your pending activities:')
 
 
 def run_show_scheduled_and_pending_activities():
@@ -166,13 +323,11 @@ def run_show_scheduled_and_pending_activities():
     pending_activities = get_pending_activities(settings.EMAIL)
 
     active_texts = [
-        'Active schedule for {} on {} at {}:{}'.format(
-            schedule['activity'], schedule['date'], *schedule['time'])
+        'Active schedule for {}'.format(schedule)
         for schedule in active_schedules
     ]
     pending_texts = [
-        'Pending activity for {} on {} at {}:{}'.format(
-            activity['activity'], activity['date'], *activity['time'])
+        'Pending activity for {}'.format(activity)
         for activity in pending_activities
     ]
 
@@ -188,16 +343,133 @@ def run_show_scheduled_and_pending_activities():
         if pending_texts else ''
     )
 
-    user_id = get_user_id_by_email(settings.EMAIL)
-    channel = get_chat_with_user(user_id)
+    outbox.add(settings.EMAIL, text)
+    outbox.flush()
 
-    sc.api_call(
-        'chat.postMessage', channel=channel, text=text, as_user=True)
+
+_LAST_CIRCUIT_STATE = CircuitBreaker.CLOSED
+
+
+def run_site_status_check():
+    global _LAST_CIRCUIT_STATE
+
+    state = CircuitBreaker().get_state()
+    if state['state'] == _LAST_CIRCUIT_STATE:
+        return
+
+    _LAST_CIRCUIT_STATE = state['state']
+
+    outbox.add(
+        settings.EMAIL,
+        'Gym site circuit is now {} ({} consecutive failures)'.format(
+            state['state'], state['failures']))
+    outbox.flush()
+
+
+def run_driver_reaper():
+    global _REAP_DRIVERS_LAST_TIME_CHECKED
+
+    delta = datetime.timedelta(minutes=_REAP_DRIVERS_INTERVAL)
+    now = datetime.datetime.now()
+    if (_REAP_DRIVERS_LAST_TIME_CHECKED is not None and
+            now - _REAP_DRIVERS_LAST_TIME_CHECKED < delta):
+        return
+
+    _REAP_DRIVERS_LAST_TIME_CHECKED = datetime.datetime.now()
+
+    get_supervisor().reap()
+
+
+def run_active_schedules_refresh():
+    global _REFRESH_ACTIVE_SCHEDULES_LAST_TIME_CHECKED
+
+    delta = datetime.timedelta(minutes=_REFRESH_ACTIVE_SCHEDULES_INTERVAL)
+    now = datetime.datetime.now()
+    if (_REFRESH_ACTIVE_SCHEDULES_LAST_TIME_CHECKED is not None and
+            now - _REFRESH_ACTIVE_SCHEDULES_LAST_TIME_CHECKED < delta):
+        return
+
+    _REFRESH_ACTIVE_SCHEDULES_LAST_TIME_CHECKED = datetime.datetime.now()
+
+    refresh_stale_active_schedules()
+
+
+_MEMORY_DIAGNOSTICS = None
+
+
+def run_memory_diagnostics():
+    global _MEMORY_DIAGNOSTICS, _MEMORY_DIAGNOSTICS_LAST_TIME_CHECKED
+
+    if settings.MEMORY_DIAGNOSTICS_INTERVAL is None:
+        return
+
+    delta = datetime.timedelta(minutes=settings.MEMORY_DIAGNOSTICS_INTERVAL)
+    now = datetime.datetime.now()
+    if (_MEMORY_DIAGNOSTICS_LAST_TIME_CHECKED is not None and
+            now - _MEMORY_DIAGNOSTICS_LAST_TIME_CHECKED < delta):
+        return
+
+    _MEMORY_DIAGNOSTICS_LAST_TIME_CHECKED = datetime.datetime.now()
+
+    if _MEMORY_DIAGNOSTICS is None:
+        _MEMORY_DIAGNOSTICS = MemoryDiagnostics(
+            settings.MEMORY_GROWTH_THRESHOLD_MB * 1024 * 1024)
+
+    report = _MEMORY_DIAGNOSTICS.check()
+    if report is None:
+        return
+
+    path = write_report(settings.PROFILES_DIR, report)
+    outbox.add(
+        settings.EMAIL,
+        'The bot is using more memory, report saved to {}\n\n{}'.format(
+            path, report))
+    outbox.flush()
 
 
 def do_stuff():
+    global _PROFILE_DO_STUFF_FOR
+
+    if _PROFILE_DO_STUFF_FOR is not None:
+        channel, _PROFILE_DO_STUFF_FOR = _PROFILE_DO_STUFF_FOR, None
+
+        # A second profiler would take over the loop profiler's hooks and
+        # leave it blind for the rest of the iteration
+        if _LOOP_PROFILER is not None and _LOOP_PROFILER.is_running():
+            slack_api.api_call(
+                'chat.postMessage', channel=channel,
+                text='This iteration is already in the loop profile, '
+                     'see {}.*'.format(_LOOP_PROFILE_PREFIX),
+                as_user=True)
+        else:
+            profile_call('do_stuff', channel, _timed_do_stuff)
+            return
+
+    _timed_do_stuff()
+
+
+def _timed_do_stuff():
+    started_at = time.time()
+    try:
+        _do_stuff()
+    finally:
+        _DO_STUFF_SECONDS.observe(time.time() - started_at)
+
+
+def _do_stuff():
+    run_driver_reaper()
+    run_site_status_check()
     run_storage()
+    run_active_schedules_refresh()
     run_show_scheduled_and_pending_activities()
+    run_memory_diagnostics()
+
+
+# Set GYM_SUB_PROFILE_EVERY=N to profile one in N loop iterations. They add
+# up in a single profile that is rewritten after each of them
+_PROFILE_EVERY = int(os.getenv('GYM_SUB_PROFILE_EVERY') or 0)
+_LOOP_PROFILER = Profiler() if _PROFILE_EVERY else None
+_LOOP_PROFILE_PREFIX = make_profile_prefix(settings.PROFILES_DIR, 'bot_loop')
 
 
 def message_checks_out(message):
@@ -205,7 +477,7 @@ def message_checks_out(message):
         message and
         message['type'] == 'message' and
         'user' in message and
-        message['user'] != _BOT_ID and
+        message['user'] != get_bot_id() and
         'channel' in message and
         is_general_channel(message['channel']) is False
     )
@@ -215,20 +487,45 @@ def run():
     if sc.rtm_connect() is False:
         raise ValueError('Could not connect')
 
+    iteration = 0
     while True:
-        messages = sc.rtm_read()
-        # Currently we only take a single message
-        message = messages[0] if messages else None
+        iteration_started_at = time.time()
 
-        if message_checks_out(message):
-            process_message(message)
-
-        do_stuff()
+        if _LOOP_PROFILER is not None and iteration % _PROFILE_EVERY == 0:
+            with _LOOP_PROFILER.running():
+                run_iteration()
+            _LOOP_PROFILER.dump(_LOOP_PROFILE_PREFIX)
+        else:
+            run_iteration()
 
+        iteration += 1
+        _LOOP_LAG.set(time.time() - iteration_started_at)
         time.sleep(1)
 
 
+def run_iteration():
+    messages = sc.rtm_read()
+    # Currently we only take a single message
+    message = messages[0] if messages else None
+
+    if message_checks_out(message):
+        handle_message(message)
+
+    if _PERIODIC_JOBS_ENABLED:
+        do_stuff()
+
+
 def entry_point():
+    configure_logging()
+    configure(SlackClient(settings.SLACK_TOKEN))
+
+    if settings.METRICS_PORT is not None:
+        try:
+            start_server(registry, settings.METRICS_PORT)
+        except Exception, e:
+            # Metrics are nice to have, not a reason to stay down
+            print 'Could not serve metrics: {}'.format(e)
+
     last_exception = (datetime.datetime.now() - datetime.timedelta(days=1), 0)
     while True:
         try:
@@ -238,7 +535,7 @@ def entry_point():
             channel = get_chat_with_user(user_id)
 
             exc_type, exc_value, exc_traceback = sys.exc_info()
-            sc.api_call(
+            slack_api.api_call(
                 'chat.postMessage', channel=channel,
                 text='ERROR: You just got an error: {}.\n Traceback:\n{}'.format(
                     e, '\n'.join(map(str, traceback.extract_tb(exc_traceback)))),
@@ -247,7 +544,7 @@ def entry_point():
             delta = datetime.datetime.now() - last_exception[0]
             last_exception = (last_exception[0], last_exception[1] + 1)
             if delta < datetime.timedelta(minutes=6) and last_exception[1] >= 5:
-                sc.api_call(
+                slack_api.api_call(
                     'chat.postMessage', channel=channel,
                     text='Exiting due to too many exceptions',
                     as_user=True)
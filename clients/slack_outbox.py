@@ -0,0 +1,164 @@
+import json
+import time
+import logging
+from collections import OrderedDict
+
+from helpers import TokenBucket
+
+
+# Requests per minute for each Slack Web API tier
+_TIER_RATES = {
+    1: 1,
+    2: 20,
+    3: 50,
+    4: 100,
+}
+
+_METHOD_TIERS = {
+    'users.list': 2,
+    'im.open': 3,
+    'channels.info': 3,
+}
+_DEFAULT_TIER = 3
+
+# chat.postMessage is special cased by Slack to about one per second
+_POST_MESSAGE_RATE = 1
+
+# In seconds, used when a ratelimited response does not say how long to wait
+_DEFAULT_RETRY_AFTER = 30
+_MAX_RETRIES = 3
+
+
+def _make_bucket(method):
+    if method == 'chat.postMessage':
+        return TokenBucket(_POST_MESSAGE_RATE)
+
+    per_minute = _TIER_RATES[_METHOD_TIERS.get(method, _DEFAULT_TIER)]
+    return TokenBucket(per_minute / 60.0, capacity=per_minute)
+
+
+class RateLimitedSlackApi(object):
+    '''
+    Wraps a SlackClient so that calls stay within the Slack tier limits and
+    are retried when Slack answers with `ratelimited` anyway.
+    '''
+
+    def __init__(self, client):
+        self._client = client
+        self._buckets = {}
+        self.call_counts = {}
+        self.error_counts = {}
+
+    def _get_bucket(self, method):
+        if method not in self._buckets:
+            self._buckets[method] = _make_bucket(method)
+
+        return self._buckets[method]
+
+    def _do_call(self, method, kwargs):
+        '''
+        Return the response and its Retry-After header, if any
+        '''
+        # SlackClient.api_call only hands back the JSON body, so go one level
+        # down to be able to see the headers
+        server = getattr(self._client, 'server', None)
+        requester = getattr(server, 'api_requester', None)
+
+        if requester is None:
+            response = self._client.api_call(method, **kwargs)
+            return response, response.get('headers', {}).get('Retry-After')
+
+        reply = requester.do(self._client.token, method, kwargs)
+        return json.loads(reply.text), reply.headers.get('Retry-After')
+
+    def api_call(self, method, **kwargs):
+        for attempt in range(_MAX_RETRIES + 1):
+            self._get_bucket(method).acquire()
+
+            self.call_counts[method] = self.call_counts.get(method, 0) + 1
+            response, retry_after = self._do_call(method, kwargs)
+
+            if response.get('ok') is False:
+                self.error_counts[method] = (
+                    self.error_counts.get(method, 0) + 1)
+
+            if response.get('error') != 'ratelimited':
+                return response
+
+            wait = int(retry_after or _DEFAULT_RETRY_AFTER)
+            logging.info('Slack rate limited {}, retrying in {} seconds'
+                         .format(method, wait))
+            time.sleep(wait)
+
+        return response
+
+
+class Outbox(object):
+    '''
+    Collects messages per recipient email and sends each recipient a single
+    digest, so the number of Slack calls grows with the number of users and
+    not with the number of messages.
+    '''
+
+    def __init__(self, api):
+        self._api = api
+        self._pending = OrderedDict()
+        # user id -> im channel. im.open always returns the same channel.
+        self._channels = {}
+
+    def add(self, email, text):
+        self._pending.setdefault(email, []).append(text)
+
+    def _get_users_by_email(self):
+        response = self._api.api_call('users.list')
+        if response.get('ok') is False:
+            raise ValueError('Something went wrong {}'.format(response))
+
+        return dict(
+            (user['profile']['email'], user['id'])
+            for user in response['members']
+            if 'email' in user['profile']
+        )
+
+    def _get_channel(self, user_id):
+        if user_id not in self._channels:
+            response = self._api.api_call('im.open', user=user_id)
+            if response.get('ok') is False:
+                raise ValueError('Something went wrong {}'.format(response))
+
+            self._channels[user_id] = response['channel']['id']
+
+        return self._channels[user_id]
+
+    def flush(self, header=None):
+        '''
+        Send everything queued so far. Return a list of (email, error) for
+        the recipients that could not be reached; the rest are sent even if
+        some fail.
+        '''
+        if not self._pending:
+            return []
+
+        users = self._get_users_by_email()
+        pending, self._pending = self._pending, OrderedDict()
+
+        failed = []
+        for email, texts in pending.items():
+            text = '\n'.join(([header] if header else []) + texts)
+
+            try:
+                if email not in users:
+                    raise ValueError('No user for email {}'.format(email))
+
+                channel = self._get_channel(users[email])
+                response = self._api.api_call(
+                    'chat.postMessage', channel=channel, text=text,
+                    as_user=True)
+                if response.get('ok') is False:
+                    raise ValueError(
+                        'Something went wrong {}'.format(response))
+            except ValueError, e:
+                logging.error('Could not notify {}: {}'.format(email, e))
+                failed.append((email, str(e)))
+
+        return failed
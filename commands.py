@@ -1,9 +1,17 @@
 import os
 import json
-import copy
+import time
+import Queue
+import bisect
+import logging
+import datetime
+import threading
 
-from scheduler import CrossfitScheduler
-from helpers import parse_date_time_string
+import settings
+from activities import Activity
+from circuit_breaker import CircuitOpenError
+from helpers import make_directory
+from schedule_cache import ActiveSchedulesCache
 
 
 _DEFAULT_STORAGE_DIR = os.path.join(os.getenv('HOME'), '.gym_sub')
@@ -13,6 +21,9 @@ _DEFAULT_STORAGE_FILE = os.path.join(
 
 
 def _get_formated_activities_from_storage(file_path):
+    '''
+    Return a list of (email, Activity) tuples
+    '''
     # If a path was not specified, we do not throw an error if the default
     # file is missing
     if os.path.exists(file_path) is False:
@@ -30,115 +41,282 @@ def _get_formated_activities_from_storage(file_path):
                 .format(file_path)
             )
 
-    for entry in data:
-        date_time = parse_date_time_string(entry.pop('date_time'))
-        entry['date'], entry['time'] = date_time
+    return _sort_by_start_time(
+        [(entry['email'], Activity.from_dict(entry)) for entry in data])
 
-    return data
 
+def _sort_by_start_time(entries):
+    # Written sorted, so this is a single pass over already ordered entries
+    return sorted(entries, key=lambda entry: entry[1].date_time)
 
-def _write_activities_to_storage(data, file_path):
-    for entry in data:
-        entry['date_time'] = '{}-{}:{}'.format(
-            entry.pop('date').strftime('%d-%m-%Y'), *entry.pop('time'))
 
-    if os.path.exists(_DEFAULT_STORAGE_FILE) is False:
-        os.mkdir(_DEFAULT_STORAGE_DIR)
-        with open(_DEFAULT_STORAGE_FILE, 'w') as file_:
-            json.dump([], file_)
+def _write_activities_to_storage(entries, file_path):
+    data = []
+    for email, activity in _sort_by_start_time(entries):
+        entry = activity.to_dict()
+        entry['email'] = email
+        data.append(entry)
+
+    # Other files (e.g. the circuit breaker state) may have created the
+    # directory already, so check for it and not for the storage file
+    make_directory(os.path.dirname(file_path))
 
     with open(file_path, 'w') as file_:
         json.dump(data, file_)
 
 
-def save_activity(email, activity_name, date, time, storage_file=None):
+def save_activity(email, activity, storage_file=None):
     file_path = storage_file or _DEFAULT_STORAGE_FILE
     entries = _get_formated_activities_from_storage(file_path)
-    entries.append({
-        'email': email,
-        'activity': activity_name,
-        'date': date,
-        'time': time
-    })
+    entries.append((email, activity))
 
     _write_activities_to_storage(entries, file_path)
 
 
-def cancel_pending_schedule(
-        email, activity_name, date, time, storage_file=None):
-    def compare_activity(activity):
-        return all((
-            activity['email'] == email,
-            activity['activity'] == activity_name,
-            activity['date'] == date,
-            activity['time'] == time
-        ))
-
+def cancel_pending_schedule(email, activity, storage_file=None):
     file_path = storage_file or _DEFAULT_STORAGE_FILE
     pending_activities = _get_formated_activities_from_storage(file_path)
 
     # Just in case there are more ...
-    target_activities = filter(compare_activity, pending_activities)
-    if not target_activities:
+    remaining = [
+        entry for entry in pending_activities if entry != (email, activity)]
+    if len(remaining) == len(pending_activities):
         raise ValueError('No pending activity found with given details')
 
-    for activity in target_activities:
-        pending_activities.remove(activity)
+    _write_activities_to_storage(remaining, file_path)
 
-    _write_activities_to_storage(pending_activities, file_path)
 
+def create_from_storage(storage_path=None, on_attempt=None):
+    '''
+    Try to schedule every stored activity. Return a list of
+    (email, activity, error) tuples for the ones that got scheduled or failed
+    for good (error is None if scheduled); the rest stay in storage.
 
-def create_from_storage(storage_path=None):
-    file_path = storage_path or _DEFAULT_STORAGE_FILE
+    Only entries whose booking window is open are tried on the site. Entries
+    that already started are dropped without looking at the site.
 
-    data = _get_formated_activities_from_storage(file_path)
+    ** on_attempt
+        Called with (email, activity, outcome) after every attempt, where
+        outcome is one of 'success', 'failure', 'not_visible' or 'expired'
+    '''
+    def report(email, activity, outcome):
+        if on_attempt is not None:
+            on_attempt(email, activity, outcome)
 
-    scheduled_activities = []
-    entries_to_be_removed = []
-    for counter in range(len(data)):
-        entry = data[counter]
-        error_message = None
-        was_scheduled = False
+    file_path = storage_path or _DEFAULT_STORAGE_FILE
 
+    # Sorted by start time: first the ones that already started, then the
+    # ones that can be booked now and last the ones that cannot be booked yet
+    entries = _get_formated_activities_from_storage(file_path)
+    start_times = [activity.date_time for _, activity in entries]
+
+    now = datetime.datetime.now()
+    window = datetime.timedelta(hours=settings.BOOKING_WINDOW_HOURS)
+    expired_end = bisect.bisect_right(start_times, now)
+    bookable_end = bisect.bisect_right(start_times, now + window)
+
+    results = []
+    for email, activity in entries[:expired_end]:
+        report(email, activity, 'expired')
+        results.append((
+            email, activity,
+            'Could not schedule you for {}, it already started'.format(
+                activity)))
+
+    bookable = entries[expired_end:bookable_end]
+    remaining = entries[bookable_end:]
+    for index, (email, activity) in enumerate(bookable):
         try:
-            was_scheduled = schedule_activity(
-                entry['email'], entry['activity'],
-                entry['date'], entry['time'])
+            was_scheduled = schedule_activity(email, activity)
+        except CircuitOpenError, e:
+            # The site is down. Keep this and the remaining entries for the
+            # next run instead of failing all of them
+            logging.info('Stopping storage run: {}'.format(e))
+            remaining.extend(bookable[index:])
+            break
         except Exception, e:
-            error_message = str(e)
+            report(email, activity, 'failure')
+            results.append((email, activity, str(e)))
+            continue
 
-        activity = copy.copy(entry)
-        activity['error'] = error_message
+        if was_scheduled:
+            report(email, activity, 'success')
+            results.append((email, activity, None))
+        else:
+            report(email, activity, 'not_visible')
+            remaining.append((email, activity))
 
-        if was_scheduled or error_message:
-            entries_to_be_removed.append(entry)
-            scheduled_activities.append(activity)
+    _write_activities_to_storage(remaining, file_path)
 
-    for entry in entries_to_be_removed:
-        data.remove(entry)
+    return results
 
-    _write_activities_to_storage(data, file_path)
 
-    return scheduled_activities
+def get_pending_activities(email, storage_path=None):
+    file_path = storage_path or _DEFAULT_STORAGE_FILE
+    entries = _get_formated_activities_from_storage(file_path)
 
+    return [activity for owner, activity in entries if owner == email]
 
-def get_pending_activities(email, storage_path=None):
+
+def get_storage_stats(storage_path=None):
     file_path = storage_path or _DEFAULT_STORAGE_FILE
-    activities = _get_formated_activities_from_storage(file_path)
 
-    return filter(lambda activity: activity['email'] == email, activities)
+    if os.path.exists(file_path) is False:
+        return {'entries': 0, 'bytes': 0}
+
+    return {
+        'entries': len(_get_formated_activities_from_storage(file_path)),
+        'bytes': os.path.getsize(file_path),
+    }
+
+
+# Each refresh is a browser session, see refresh_stale_active_schedules
+_MAX_REFRESHES_PER_RUN = 2
+# email -> when refreshing its active schedules last failed
+_REFRESH_FAILURES = {}
+
+
+def get_scheduler_class():
+    # The scheduler pulls in selenium, which is too much for commands that
+    # only touch the storage file. Load it on first use instead.
+    from scheduler import CrossfitScheduler
+
+    return CrossfitScheduler
+
+
+def get_active_schedules(email, force_refresh=False):
+    cache = ActiveSchedulesCache()
+
+    if not force_refresh:
+        schedules = cache.get(email)
+        if schedules is not None:
+            return schedules
+
+    with get_scheduler_class()(email) as scheduler:
+        schedules = scheduler.get_active_schedules()
+
+    cache.set(email, schedules)
 
+    return schedules
 
-def get_active_schedules(email):
-    with CrossfitScheduler(email) as scheduler:
-        return scheduler.get_active_schedules()
 
+def refresh_stale_active_schedules(max_refreshes=_MAX_REFRESHES_PER_RUN):
+    '''
+    Refresh the active schedules of at most `max_refreshes` emails whose
+    cache is stale, so a single run does not keep the caller busy for long.
+    Failures are logged and tried again on a later run.
+    '''
+    stale_emails = ActiveSchedulesCache().get_stale_emails()
+    # Emails that keep failing go last so they do not starve the others
+    stale_emails.sort(key=lambda email: _REFRESH_FAILURES.get(email, 0))
+
+    for email in stale_emails[:max_refreshes]:
+        try:
+            get_active_schedules(email, force_refresh=True)
+        except CircuitOpenError, e:
+            logging.info('Not refreshing active schedules: {}'.format(e))
+            return
+        except Exception, e:
+            logging.error('Could not refresh active schedules of {}: {}'
+                          .format(email, e))
+            _REFRESH_FAILURES[email] = time.time()
+        else:
+            _REFRESH_FAILURES.pop(email, None)
+
+
+def schedule_activity(email, activity):
+    with get_scheduler_class()(email) as scheduler:
+        was_scheduled = scheduler.schedule(activity)
+
+    if was_scheduled:
+        ActiveSchedulesCache().add(email, activity)
+
+    return was_scheduled
+
+
+def cancel_schedule(email, activity):
+    with get_scheduler_class()(email) as scheduler:
+        was_cancelled = scheduler.cancel_schedule(activity)
+
+    if was_cancelled:
+        ActiveSchedulesCache().remove(email, activity)
+
+    return was_cancelled
 
-def schedule_activity(email, activity, date, time):
-    with CrossfitScheduler(email) as scheduler:
-        return scheduler.schedule(activity, date, time)
 
+def cancel_many(email, activities):
+    '''
+    Cancel all the activities in a single session. Return a list of
+    (activity, error) tuples, error being None for the cancelled ones.
+    '''
+    with get_scheduler_class()(email) as scheduler:
+        results = scheduler.cancel_many(activities)
+
+    cache = ActiveSchedulesCache()
+    for activity, error in results:
+        if error is None:
+            cache.remove(email, activity)
+
+    return results
+
+
+def schedule_first_available(email, activities, on_scheduled=None):
+    '''
+    Try to schedule all the activities at once, each in its own browser
+    session, and keep only the first one that gets scheduled. Any other that
+    also gets scheduled is cancelled.
+
+    Return a list of (activity, status, error) tuples in the order the
+    attempts finished. Status is one of 'scheduled', 'not_visible', 'failed',
+    'cancelled' (scheduled after another one and then cancelled) or
+    'cancel_failed' (scheduled after another one and could not be cancelled).
+
+    ** on_scheduled
+        Called with the winning activity as soon as it is known, before
+        waiting for the other attempts to finish
+    '''
+    finished = Queue.Queue()
+
+    def attempt(activity):
+        try:
+            finished.put((activity, schedule_activity(email, activity), None))
+        except Exception, e:
+            finished.put((activity, False, e))
+
+    for activity in activities:
+        thread = threading.Thread(target=attempt, args=(activity,))
+        thread.daemon = True
+        thread.start()
+
+    winner = None
+    results = []
+    for _ in activities:
+        activity, was_scheduled, error = finished.get()
+
+        if error is not None:
+            results.append((activity, 'failed', error))
+            continue
+
+        if not was_scheduled:
+            results.append((activity, 'not_visible', None))
+            continue
+
+        if winner is None:
+            winner = activity
+            results.append((activity, 'scheduled', None))
+            if on_scheduled is not None:
+                on_scheduled(activity)
+            continue
+
+        logging.info('Cancelling extra schedule {}, already got {}'.format(
+            activity, winner))
+        try:
+            cancel_schedule(email, activity)
+        except Exception, e:
+            logging.error('Could not cancel extra schedule {}: {}'.format(
+                activity, e))
+            results.append((activity, 'cancel_failed', e))
+        else:
+            results.append((activity, 'cancelled', None))
 
-def cancel_schedule(email, activity, date, time):
-    with CrossfitScheduler(email) as scheduler:
-        return scheduler.cancel_schedule(activity, date, time)
+    return results
@@ -0,0 +1,298 @@
+import os
+import json
+import time
+import errno
+import atexit
+import signal
+import logging
+
+import settings
+from helpers import make_directory
+
+
+_DEFAULT_REGISTRY_DIR = os.path.join(os.getenv('HOME'), '.gym_sub', 'drivers')
+
+_PROCESS_NAME = 'phantomjs'
+# In seconds
+_TERMINATE_GRACE_PERIOD = 2
+
+
+def _read_proc_status(pid):
+    try:
+        with open('/proc/{}/status'.format(pid), 'r') as file_:
+            lines = file_.read().splitlines()
+    except IOError:
+        return None
+
+    status = {}
+    for line in lines:
+        key, _, value = line.partition(':')
+        status[key] = value.strip()
+
+    return status
+
+
+def get_start_time(pid):
+    '''
+    Return when the process started in clock ticks since boot, or None if it
+    is gone. Together with the pid it identifies a process, pids get reused.
+    '''
+    try:
+        with open('/proc/{}/stat'.format(pid), 'r') as file_:
+            stat = file_.read()
+    except IOError:
+        return None
+
+    # The name is in parentheses and may contain spaces, the start time is
+    # the 22nd field
+    return int(stat.rpartition(')')[2].split()[19])
+
+
+def is_driver(pid, start_time=None):
+    '''
+    Whether the pid still belongs to a PhantomJS process, the one that
+    started at `start_time` if given
+    '''
+    status = _read_proc_status(pid)
+    if not status or status.get('Name') != _PROCESS_NAME:
+        return False
+
+    return start_time is None or get_start_time(pid) == start_time
+
+
+def is_alive(pid):
+    status = _read_proc_status(pid)
+
+    # Zombies are dead for all we care, they just have not been waited for
+    return bool(status) and not status.get('State', '').startswith('Z')
+
+
+def get_rss(pid):
+    '''
+    Return the resident memory of the process in bytes, or 0 if it is gone.
+    '''
+    status = _read_proc_status(pid)
+    if not status or 'VmRSS' not in status:
+        return 0
+
+    # e.g. "123456 kB"
+    return int(status['VmRSS'].split()[0]) * 1024
+
+
+def kill(pid, start_time=None):
+    '''
+    Kill the driver process, unless the pid now belongs to something else
+    '''
+    if not is_alive(pid) or not is_driver(pid, start_time):
+        return
+
+    logging.info('Killing driver process {}'.format(pid))
+
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.kill(pid, sig)
+        except OSError, e:
+            if e.errno == errno.ESRCH:
+                return
+            if e.errno == errno.EPERM:
+                # Not ours (anymore), nothing we can do about it
+                logging.error('Not allowed to kill process {}'.format(pid))
+                return
+            raise
+
+        deadline = time.time() + _TERMINATE_GRACE_PERIOD
+        while time.time() < deadline:
+            # Reap it if it is our child so it does not stay a zombie
+            try:
+                os.waitpid(pid, os.WNOHANG)
+            except OSError:
+                pass
+
+            if not is_alive(pid):
+                return
+
+            time.sleep(0.1)
+
+
+def get_driver_pid(driver):
+    '''
+    Return the pid of the browser behind the driver, or None if there is no
+    process (e.g. a replay driver)
+    '''
+    service = getattr(driver, 'service', None)
+    process = getattr(service, 'process', None)
+
+    return process.pid if process else None
+
+
+class DriverSupervisor(object):
+    '''
+    Keeps track of every PhantomJS process we start so none outlive their
+    owner.
+
+    Each driver gets a record in `registry_dir` with the pid of the process
+    that launched it. `reap` kills drivers whose owner is gone, drivers older
+    than `max_age` (no single operation takes that long, so they are either
+    hung or leaked) and PhantomJS processes that got orphaned without ever
+    being recorded. Drivers started by this process are also killed on exit.
+    '''
+
+    def __init__(self, registry_dir=None, max_rss=None, max_age=None):
+        self._registry_dir = registry_dir or _DEFAULT_REGISTRY_DIR
+        self._max_rss = max_rss or settings.DRIVER_MAX_RSS_MB * 1024 * 1024
+        self._max_age = max_age or settings.DRIVER_MAX_AGE
+        self._own_pids = set()
+
+        atexit.register(self.kill_own)
+
+    def _record_path(self, pid):
+        return os.path.join(self._registry_dir, '{}.json'.format(pid))
+
+    def _read_records(self):
+        if os.path.exists(self._registry_dir) is False:
+            return []
+
+        records = []
+        for file_name in os.listdir(self._registry_dir):
+            path = os.path.join(self._registry_dir, file_name)
+            try:
+                with open(path, 'r') as file_:
+                    records.append(json.load(file_))
+            except (IOError, ValueError):
+                # Half written or just removed by someone else
+                continue
+
+        return records
+
+    def _remove_record(self, pid):
+        try:
+            os.remove(self._record_path(pid))
+        except OSError:
+            pass
+
+    def register(self, driver):
+        pid = get_driver_pid(driver)
+        if pid is None:
+            return
+
+        make_directory(self._registry_dir)
+
+        with open(self._record_path(pid), 'w') as file_:
+            json.dump({
+                'pid': pid,
+                'start_time': get_start_time(pid),
+                'owner_pid': os.getpid(),
+                'started_at': time.time(),
+            }, file_)
+
+        self._own_pids.add(pid)
+        logging.info('Registered driver process {}'.format(pid))
+
+    def release(self, driver):
+        '''
+        Make sure the driver process is gone. Safe to call after quit().
+        '''
+        pid = get_driver_pid(driver)
+        if pid is None:
+            return
+
+        kill(pid)
+        self._remove_record(pid)
+        self._own_pids.discard(pid)
+
+    def kill_own(self):
+        for pid in list(self._own_pids):
+            kill(pid)
+            self._remove_record(pid)
+
+        self._own_pids.clear()
+
+    def is_over_memory_limit(self, driver):
+        pid = get_driver_pid(driver)
+
+        return pid is not None and get_rss(pid) > self._max_rss
+
+    def _find_orphans(self):
+        orphans = []
+        uid = os.getuid()
+
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+
+            status = _read_proc_status(entry)
+            if not status or status.get('Name') != _PROCESS_NAME:
+                continue
+
+            # Only our own processes that lost their parent
+            if (status.get('PPid') == '1' and
+                    int(status.get('Uid', '-1').split()[0]) == uid):
+                orphans.append(int(entry))
+
+        return orphans
+
+    def reap(self):
+        '''
+        Kill leaked drivers and return how many were killed
+        '''
+        killed = 0
+        now = time.time()
+
+        for record in self._read_records():
+            pid = record['pid']
+
+            # Gone, or the pid got reused by something that is not our driver
+            if not is_alive(pid) or not is_driver(
+                    pid, record.get('start_time')):
+                self._remove_record(pid)
+                self._own_pids.discard(pid)
+                continue
+
+            if not is_alive(record['owner_pid']):
+                logging.info('Driver {} outlived its owner {}'.format(
+                    pid, record['owner_pid']))
+            elif now - record['started_at'] > self._max_age:
+                logging.info('Driver {} is older than {} seconds'.format(
+                    pid, self._max_age))
+            else:
+                continue
+
+            kill(pid, record.get('start_time'))
+            self._remove_record(pid)
+            self._own_pids.discard(pid)
+            killed += 1
+
+        for pid in self._find_orphans():
+            logging.info('Killing orphaned driver {}'.format(pid))
+            kill(pid)
+            killed += 1
+
+        return killed
+
+    def get_stats(self):
+        '''
+        Return the number of live drivers and their total resident memory in
+        bytes
+        '''
+        pids = [
+            record['pid'] for record in self._read_records()
+            if is_alive(record['pid']) and
+            is_driver(record['pid'], record.get('start_time'))
+        ]
+
+        return {
+            'live_drivers': len(pids),
+            'rss': sum(get_rss(pid) for pid in pids),
+        }
+
+
+_SUPERVISOR = None
+
+
+def get_supervisor():
+    global _SUPERVISOR
+
+    if _SUPERVISOR is None:
+        _SUPERVISOR = DriverSupervisor()
+
+    return _SUPERVISOR
@@ -0,0 +1,188 @@
+'''
+History of what the timetable looked like over time, used to learn how fast
+each class fills up.
+
+Every timetable scrape appends the classes that became schedulable and the
+ones that stopped being schedulable since the previous scrape, and every
+booking attempt appends its outcome, one JSON object per line. What the
+previous scrape saw is kept in a small state file next to the history. A
+class is considered full once it stops being schedulable before it started,
+or once an attempt found no open positions.
+'''
+import os
+import json
+import time
+import fcntl
+import datetime
+
+from activities import Activity
+from helpers import (
+    format_date_time, locked_json_file, make_directory,
+    parse_date_time_string)
+
+
+_DEFAULT_HISTORY_FILE = os.path.join(
+    os.getenv('HOME'), '.gym_sub', 'fill_history.jsonl')
+_VISIBLE_FILE_SUFFIX = '.visible.json'
+
+_SLOT_SEPARATOR = '|'
+
+
+def _slot_key(activity):
+    return '{}{}{}'.format(
+        activity.name, _SLOT_SEPARATOR, format_date_time(activity.date_time))
+
+
+def _slot_from_key(key):
+    name, date_time = key.split(_SLOT_SEPARATOR)
+    return Activity(name, parse_date_time_string(date_time))
+
+
+def _has_started(key, now):
+    starts_at = time.mktime(_slot_from_key(key).date_time.timetuple())
+    return now >= starts_at
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+
+    if len(values) % 2:
+        return values[middle]
+
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+class FillHistory(object):
+
+    SUCCESS = 'success'
+    FULL = 'full'
+    NOT_VISIBLE = 'not_visible'
+
+    def __init__(self, history_file=None):
+        self._history_file = history_file or _DEFAULT_HISTORY_FILE
+        self._visible_file = self._history_file + _VISIBLE_FILE_SUFFIX
+
+    def _append(self, record):
+        make_directory(os.path.dirname(self._history_file))
+
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with open(self._history_file, 'a') as file_:
+            fcntl.flock(file_, fcntl.LOCK_EX)
+            try:
+                file_.write(line)
+            finally:
+                fcntl.flock(file_, fcntl.LOCK_UN)
+
+    def _read(self):
+        if os.path.exists(self._history_file) is False:
+            return
+
+        with open(self._history_file, 'r') as file_:
+            fcntl.flock(file_, fcntl.LOCK_SH)
+            try:
+                lines = file_.readlines()
+            finally:
+                fcntl.flock(file_, fcntl.LOCK_UN)
+
+        for line in lines:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # A line cut short by a crash
+                continue
+
+    def record_scrape(self, activities):
+        '''
+        ** activities
+            Every class that could be scheduled in the scraped timetable
+        '''
+        now = time.time()
+        visible = set(_slot_key(activity) for activity in activities)
+
+        # Held while appending so concurrent scrapes are written in the
+        # order they are compared
+        with locked_json_file(self._visible_file, list) as previous:
+            previous_visible = set(previous)
+            appeared = visible - previous_visible
+            # Classes that started are expected to go away, that is not news
+            gone = set(
+                key for key in previous_visible - visible
+                if not _has_started(key, now))
+
+            if appeared or gone:
+                self._append({
+                    't': now,
+                    'appeared': sorted(appeared),
+                    'gone': sorted(gone),
+                })
+
+            previous[:] = sorted(visible)
+
+    def record_attempt(self, activity, outcome):
+        self._append({
+            't': time.time(),
+            'slot': _slot_key(activity),
+            'outcome': outcome,
+        })
+
+    def get_slot_histories(self):
+        '''
+        Return a dictionary mapping every Activity ever seen to a dictionary
+        with the timestamps it was first seen schedulable ('visible_at') and
+        found to be full ('full_at', None if not yet).
+        '''
+        histories = {}
+
+        def get_history(key, now):
+            if key not in histories:
+                histories[key] = {'visible_at': now, 'full_at': None}
+            return histories[key]
+
+        for record in self._read():
+            now = record['t']
+
+            if 'appeared' in record:
+                for key in record['appeared']:
+                    get_history(key, now)
+
+                # Gone although they did not start yet, so they got full
+                for key in record['gone']:
+                    history = get_history(key, now)
+                    if history['full_at'] is None:
+                        history['full_at'] = now
+
+            elif record.get('outcome') == self.FULL:
+                history = get_history(record['slot'], now)
+                if history['full_at'] is None:
+                    history['full_at'] = now
+
+        return dict(
+            (_slot_from_key(key), history)
+            for key, history in histories.items()
+        )
+
+    def get_typical_time_to_full(self):
+        '''
+        Return a dictionary mapping (name, weekday, (hour, minute)) class
+        slots to the median number of seconds it takes from a class becoming
+        schedulable to it being full, over all the dates it got full.
+        '''
+        times = {}
+        for activity, history in self.get_slot_histories().items():
+            if history['full_at'] is None:
+                continue
+
+            slot = (
+                activity.name,
+                activity.date_time.weekday(),
+                (activity.date_time.hour, activity.date_time.minute),
+            )
+            times.setdefault(slot, []).append(
+                history['full_at'] - history['visible_at'])
+
+        return dict((slot, _median(values)) for slot, values in times.items())
+
+
+def format_duration(seconds):
+    return str(datetime.timedelta(seconds=int(seconds)))
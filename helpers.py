@@ -1,36 +1,181 @@
-from collections import namedtuple
+import contextlib
 import datetime
+import fcntl
+import json
+import logging
+import os
 import re
+import sys
+import threading
+import time
 
 
-# TODO: do not use this anymore. have it all be a datetime object
+def configure_logging():
+    '''
+    Called by the entry points, before anything gets logged. Once a message
+    is logged without handlers, basicConfig does nothing anymore.
+    '''
+    logging.basicConfig(filename='gym.log', level=logging.INFO)
 
 
-def _get_time(time_value):
-    def check_bounds(value, lower, upper):
-        if not lower <= value <= upper:
-            raise ValueError('Invalid time value')
+# DD-MM-YYYY-HH:MM, single digits allowed everywhere but the year
+_DATE_TIME_RE = re.compile(
+    r'^(\d{1,2})-(\d{1,2})-(\d{4})-(\d{1,2}):(\d{1,2})$')
 
-    if not re.match('\d{1,2}:\d{1,2}', time_value):
-        raise ValueError('Invalid time value')
 
-    hour_str, minute_str = time_value.split(':')
-    hour = int(hour_str)
-    minute = int(minute_str)
+def parse_date_time_string(value):
+    match = _DATE_TIME_RE.match(value)
+    if match is None:
+        raise ValueError('Invalid date time value {}'.format(value))
 
-    check_bounds(hour, 0, 60)
-    check_bounds(minute, 0, 60)
+    day, month, year, hour, minute = [int(group) for group in match.groups()]
 
-    return hour, minute
+    # Raises ValueError for out of range values
+    return datetime.datetime(year, month, day, hour, minute)
 
 
-def parse_date_time_string(value):
-    DateTimeType = namedtuple('DateTimeType', ['date', 'time'])
-    values = value.split('-')
-    time_str = values.pop()
-    date_str = '-'.join(values)
+def format_date_time(date_time):
+    '''
+    The inverse of parse_date_time_string
+    '''
+    return '{:02d}-{:02d}-{}-{:02d}:{:02d}'.format(
+        date_time.day, date_time.month, date_time.year,
+        date_time.hour, date_time.minute)
+
+
+def make_directory(directory):
+    '''
+    Create the directory and its parents unless they exist. Safe to call from
+    many processes at once.
+    '''
+    if directory and os.path.exists(directory) is False:
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if os.path.exists(directory) is False:
+                raise
+
+
+def read_locked_json_file(path, default):
+    '''
+    Return the content of the JSON file at `path` (or `default()` if it is
+    missing or broken), read under a shared lock. Unlike locked_json_file
+    it never writes.
+    '''
+    if os.path.exists(path) is False:
+        return default()
+
+    with open(path, 'r') as file_:
+        fcntl.flock(file_, fcntl.LOCK_SH)
+        try:
+            return json.loads(file_.read())
+        except ValueError:
+            return default()
+        finally:
+            fcntl.flock(file_, fcntl.LOCK_UN)
+
+
+@contextlib.contextmanager
+def locked_json_file(path, default):
+    '''
+    Yield the content of the JSON file at `path` (or `default()` if it is
+    missing or broken) while holding an exclusive lock on it, and write it
+    back afterwards. Processes sharing the file see each other's changes.
+    '''
+    make_directory(os.path.dirname(path))
+
+    with open(path, 'a+') as file_:
+        fcntl.flock(file_, fcntl.LOCK_EX)
+        try:
+            file_.seek(0)
+            try:
+                data = json.loads(file_.read())
+            except ValueError:
+                data = default()
+
+            yield data
+
+            file_.seek(0)
+            file_.truncate()
+            json.dump(data, file_)
+            file_.flush()
+        finally:
+            fcntl.flock(file_, fcntl.LOCK_UN)
+
+
+class OperationTimeoutError(Exception):
+    pass
+
+
+def run_with_timeout(timeout, func, *args, **kwargs):
+    '''
+    Run func in a separate thread and raise OperationTimeoutError if it
+    does not finish in `timeout` seconds. A falsy timeout means no limit.
+
+    The thread is left behind if it times out; it is a daemon so it will not
+    keep the process alive.
+    '''
+    if not timeout:
+        return func(*args, **kwargs)
+
+    result = {}
+
+    def target():
+        try:
+            result['value'] = func(*args, **kwargs)
+        except Exception:
+            result['error'] = sys.exc_info()
+
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.start()
+    thread.join(timeout)
+
+    if thread.is_alive():
+        raise OperationTimeoutError(
+            '{} did not finish in {} seconds'.format(
+                getattr(func, '__name__', func), timeout))
+
+    if 'error' in result:
+        exc_type, exc_value, exc_traceback = result['error']
+        raise exc_type, exc_value, exc_traceback
+
+    return result['value']
+
+
+class TokenBucket(object):
+    '''
+    Allows `rate` operations per second on average with bursts of up to
+    `capacity`. Safe to share between threads.
+    '''
+
+    def __init__(self, rate, capacity=1):
+        self._rate = float(rate)
+        self._capacity = float(capacity)
+        self._tokens = float(capacity)
+        self._last_refill = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self._last_refill
+        self._tokens = min(self._capacity, self._tokens + elapsed * self._rate)
+        self._last_refill = now
+
+    def acquire(self):
+        '''
+        Take a token, sleeping until one is available. Return the number of
+        seconds spent waiting.
+        '''
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill(time.time())
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
 
-    date = datetime.datetime.strptime(date_str, '%d-%m-%Y').date()
-    time = _get_time(time_str)
+                wait = (1 - self._tokens) / self._rate
 
-    return DateTimeType(date, time)
+            time.sleep(wait)
+            waited += wait
@@ -0,0 +1,131 @@
+'''
+Checks how long the interpreter takes to get each CLI command going.
+
+The slack bot shells out to `gym_sub` for every message, so whatever the
+command imports is paid on every reply. Each command is run in a fresh
+interpreter and the check fails if it goes over its budget or if a command
+that only reads the storage file ends up loading selenium.
+
+Usage:
+    python import_budget.py
+'''
+import os
+import sys
+import json
+import shutil
+import tempfile
+import subprocess
+
+
+# In seconds
+_DEFAULT_BUDGET = 0.5
+_BROWSER_MODULES = ('selenium', 'scheduler')
+
+_RESULT_MARKER = 'IMPORT_BUDGET_RESULT '
+
+_STORAGE_FILE_PLACEHOLDER = '{storage_file}'
+
+# (args, budget, may load the browser stack)
+COMMANDS = (
+    (['site_status'], _DEFAULT_BUDGET, False),
+    (['driver_status'], _DEFAULT_BUDGET, False),
+    (['fill_rates'], _DEFAULT_BUDGET, False),
+    (['serve_timetable', '--help'], _DEFAULT_BUDGET, False),
+    (['gym_schedule', 'list_pending', '--email', 'x@x.com',
+      '--storage-file', _STORAGE_FILE_PLACEHOLDER], _DEFAULT_BUDGET, False),
+    (['gym_schedule', 'cancel_pending', '--help'], _DEFAULT_BUDGET, False),
+    (['gym_schedule', 'list_active', '--help'], _DEFAULT_BUDGET, False),
+    (['gym_schedule', 'create', '--help'], _DEFAULT_BUDGET, False),
+    (['gym_schedule', 'cancel', '--help'], _DEFAULT_BUDGET, False),
+    (['gym_schedule', 'create_from_storage', '--help'],
+     _DEFAULT_BUDGET, False),
+)
+
+_CHILD_SCRIPT = '''
+import sys
+import time
+import json
+
+start = time.time()
+from clients.cli import cli
+try:
+    cli.main(args={args}, prog_name='gym_sub', standalone_mode=False)
+except SystemExit:
+    pass
+elapsed = time.time() - start
+
+loaded = [name for name in {browser_modules} if name in sys.modules]
+sys.stderr.write('{marker}' + json.dumps(
+    {{'elapsed': elapsed, 'loaded': loaded}}) + '\\n')
+'''
+
+
+def measure_command(args):
+    script = _CHILD_SCRIPT.format(
+        args=repr(args), browser_modules=repr(_BROWSER_MODULES),
+        marker=_RESULT_MARKER)
+
+    # Run somewhere else so the files the command writes, like gym.log, do
+    # not end up in the repo
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [repo_dir] + filter(None, [env.get('PYTHONPATH')]))
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        process = subprocess.Popen(
+            [sys.executable, '-c', script], cwd=work_dir, env=env,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        _, stderr = process.communicate()
+    finally:
+        shutil.rmtree(work_dir)
+
+    for line in reversed(stderr.splitlines()):
+        if line.startswith(_RESULT_MARKER):
+            return json.loads(line[len(_RESULT_MARKER):])
+
+    raise ValueError(
+        'Command {} did not report its import time. Output: {}'
+        .format(' '.join(args), stderr))
+
+
+def check_budgets(commands=COMMANDS):
+    '''
+    Return a list of (command, message) tuples for every command that went
+    over its budget or loaded the browser stack when it should not have.
+    '''
+    fd, storage_file = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(fd, 'w') as file_:
+        json.dump([], file_)
+
+    failures = []
+    try:
+        for args, budget, may_load_browser in commands:
+            args = [
+                storage_file if arg == _STORAGE_FILE_PLACEHOLDER else arg
+                for arg in args
+            ]
+            command = ' '.join(args)
+            result = measure_command(args)
+
+            if result['elapsed'] > budget:
+                failures.append((command, 'took {:.3f}s, budget is {:.3f}s'
+                                 .format(result['elapsed'], budget)))
+
+            if result['loaded'] and not may_load_browser:
+                failures.append((command, 'loaded {}'.format(
+                    ', '.join(result['loaded']))))
+    finally:
+        os.remove(storage_file)
+
+    return failures
+
+
+if __name__ == '__main__':
+    failures = check_budgets()
+
+    for command, message in failures:
+        print '{}: {}'.format(command, message)
+
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,134 @@
+'''
+Find out what the long running slack bot keeps in memory.
+
+Every snapshot records the resident memory of the process and how many live
+objects there are of each type, plus a tracemalloc snapshot when tracemalloc
+is available (it is not part of Python 2, pytracemalloc provides it). Once
+the resident memory grew more than `growth_threshold` bytes since the first
+snapshot, `check` returns a report of what grew the most: allocation sites
+when tracemalloc is there, object types otherwise, and the number of live
+schedulers, drivers, web elements and activities.
+'''
+import gc
+import os
+import time
+import datetime
+import collections
+
+from helpers import make_directory
+from driver_supervisor import get_rss
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+# Types we create per operation and expect to go away after it
+_WATCHED_TYPES = (
+    'CrossfitScheduler', 'WebDriver', 'RecordingDriver', 'WebElement',
+    '_RecordingElement', 'Activity',
+)
+
+_TOP_COUNT = 15
+# Frames kept for each allocation
+_TRACEMALLOC_FRAMES = 5
+
+
+def count_objects():
+    '''
+    Return a Counter of the live objects tracked by the garbage collector by
+    type name
+    '''
+    return collections.Counter(
+        type(obj).__name__ for obj in gc.get_objects())
+
+
+class MemoryDiagnostics(object):
+
+    def __init__(self, growth_threshold):
+        self._growth_threshold = growth_threshold
+        self._baseline = None
+        self._alert_rss = None
+
+        if tracemalloc is not None and not tracemalloc.is_tracing():
+            tracemalloc.start(_TRACEMALLOC_FRAMES)
+
+    def _take_snapshot(self):
+        gc.collect()
+
+        return {
+            'taken_at': time.time(),
+            'rss': get_rss(os.getpid()),
+            'objects': count_objects(),
+            'tracemalloc': (
+                tracemalloc.take_snapshot() if tracemalloc is not None
+                else None),
+        }
+
+    def _get_top_growth(self, snapshot):
+        if snapshot['tracemalloc'] is not None:
+            differences = snapshot['tracemalloc'].compare_to(
+                self._baseline['tracemalloc'], 'lineno')
+            return [
+                '{} B in {} blocks at {}'.format(
+                    difference.size_diff, difference.count_diff,
+                    difference.traceback)
+                for difference in differences[:_TOP_COUNT]
+            ]
+
+        growth = snapshot['objects'] - self._baseline['objects']
+        return [
+            '{} more {}'.format(count, name)
+            for name, count in growth.most_common(_TOP_COUNT)
+        ]
+
+    def make_report(self, snapshot):
+        lines = [
+            'Resident memory grew from {:.1f} MB to {:.1f} MB in {}'.format(
+                self._baseline['rss'] / 1024.0 / 1024.0,
+                snapshot['rss'] / 1024.0 / 1024.0,
+                datetime.timedelta(seconds=int(
+                    snapshot['taken_at'] - self._baseline['taken_at']))),
+            '',
+            'Live objects:',
+        ]
+        lines.extend(
+            '{} {}'.format(name, snapshot['objects'][name])
+            for name in _WATCHED_TYPES
+        )
+        lines.extend(['', 'Top growth:'])
+        lines.extend(self._get_top_growth(snapshot))
+
+        return '\n'.join(lines) + '\n'
+
+    def check(self):
+        '''
+        Take a snapshot. Return a report if memory grew past the threshold
+        since the first snapshot, None otherwise. After a report the next one
+        comes after another `growth_threshold` bytes of growth.
+        '''
+        snapshot = self._take_snapshot()
+
+        if self._baseline is None:
+            self._baseline = snapshot
+            self._alert_rss = snapshot['rss'] + self._growth_threshold
+            return None
+
+        if snapshot['rss'] < self._alert_rss:
+            return None
+
+        self._alert_rss = snapshot['rss'] + self._growth_threshold
+
+        return self.make_report(snapshot)
+
+
+def write_report(directory, report):
+    make_directory(directory)
+
+    path = os.path.join(directory, 'memory-{}-{}.txt'.format(
+        datetime.datetime.now().strftime('%Y%m%d-%H%M%S'), os.getpid()))
+    with open(path, 'w') as file_:
+        file_.write(report)
+
+    return path
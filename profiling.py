@@ -0,0 +1,242 @@
+'''
+Profile gym_sub commands and the slack bot without touching their code.
+
+Profiler records two profiles at the same time, in every thread (the driver
+calls we time out run in their own threads):
+- a deterministic one with cProfile, written as <prefix>.pstats for pstats,
+  snakeviz and the like
+- a sampled one, written as <prefix>.collapsed, one "thread;frame;frame count"
+  line per stack, for flamegraph.pl or speedscope
+
+<prefix>.txt splits the wall time into Python CPU time and time spent
+waiting for WebDriver (sampled, any thread waiting for the browser counts).
+'''
+import os
+import sys
+import time
+import pstats
+import cProfile
+import logging
+import datetime
+import threading
+import contextlib
+import collections
+
+from helpers import make_directory
+
+
+# In seconds
+_DEFAULT_SAMPLE_INTERVAL = 0.005
+
+# Every command we send to the browser goes through this
+_WEBDRIVER_FILE = os.path.join(
+    'selenium', 'webdriver', 'remote', 'remote_connection.py')
+
+
+def _get_cpu_time():
+    user, system = os.times()[:2]
+    return user + system
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return '{} ({}:{})'.format(
+        code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+class _Sampler(threading.Thread):
+
+    def __init__(self, profiler, interval):
+        super(_Sampler, self).__init__(name='profiler-sampler')
+        self.daemon = True
+        self._profiler = profiler
+        self._interval = interval
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def run(self):
+        own_id = threading.current_thread().ident
+
+        while not self._stopped.is_set():
+            names = dict(
+                (thread.ident, thread.name)
+                for thread in threading.enumerate())
+
+            started_at = time.time()
+            stacks = []
+            waiting_for_webdriver = False
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+
+                labels = []
+                while frame is not None:
+                    if frame.f_code.co_filename.endswith(_WEBDRIVER_FILE):
+                        waiting_for_webdriver = True
+                    labels.append(_frame_label(frame))
+                    frame = frame.f_back
+
+                labels.append(names.get(thread_id, str(thread_id)))
+                stacks.append(';'.join(reversed(labels)))
+
+            self._profiler._add_samples(
+                stacks, waiting_for_webdriver, time.time() - started_at)
+
+            self._stopped.wait(self._interval)
+
+
+class Profiler(object):
+    '''
+    Can be started and stopped many times, the profiles add up until they are
+    written with `dump`
+    '''
+
+    def __init__(self, sample_interval=_DEFAULT_SAMPLE_INTERVAL):
+        self._sample_interval = sample_interval
+        self._lock = threading.Lock()
+        # Finished profiles are merged in here so they do not pile up
+        self._stats = None
+        # (thread, profiler) for the threads started while running
+        self._thread_profilers = []
+        self._main_profiler = None
+        self._sampler = None
+
+        self._stacks = collections.Counter()
+        self._ticks = 0
+        self._webdriver_ticks = 0
+        self._wall_time = 0.0
+        self._cpu_time = 0.0
+        # The sampler runs in this process too, its CPU is not the program's
+        self._sampling_time = 0.0
+
+        self._started_at = None
+        self._cpu_started_at = None
+
+    def _add_samples(self, stacks, waiting_for_webdriver, sampling_time):
+        with self._lock:
+            self._stacks.update(stacks)
+            self._ticks += 1
+            if waiting_for_webdriver:
+                self._webdriver_ticks += 1
+            self._sampling_time += sampling_time
+
+    def _profile_new_thread(self, frame, event, arg):
+        # Called on the first event of every thread started while we run
+        sys.setprofile(None)
+
+        thread = threading.current_thread()
+        if isinstance(thread, _Sampler):
+            return
+
+        profiler = cProfile.Profile()
+        with self._lock:
+            self._thread_profilers.append((thread, profiler))
+        profiler.enable()
+
+    def _merge(self, profiler):
+        if self._stats is None:
+            self._stats = pstats.Stats(profiler)
+        else:
+            self._stats.add(profiler)
+
+    def _merge_finished_profiles(self):
+        '''
+        Move the profiles of the threads that are done into self._stats.
+        Profiles of threads still running cannot be read without breaking
+        them, they get merged by a later call.
+        '''
+        with self._lock:
+            finished = [
+                profiler for thread, profiler in self._thread_profilers
+                if not thread.is_alive()
+            ]
+            self._thread_profilers = [
+                (thread, profiler)
+                for thread, profiler in self._thread_profilers
+                if thread.is_alive()
+            ]
+
+        for profiler in finished:
+            self._merge(profiler)
+
+    def start(self):
+        self._started_at = time.time()
+        self._cpu_started_at = _get_cpu_time()
+
+        threading.setprofile(self._profile_new_thread)
+        self._main_profiler = cProfile.Profile()
+        self._main_profiler.enable()
+
+        self._sampler = _Sampler(self, self._sample_interval)
+        self._sampler.start()
+
+    def stop(self):
+        self._main_profiler.disable()
+        threading.setprofile(None)
+        self._sampler.stop()
+
+        self._merge(self._main_profiler)
+        self._main_profiler = None
+        self._merge_finished_profiles()
+
+        self._wall_time += time.time() - self._started_at
+        self._cpu_time += _get_cpu_time() - self._cpu_started_at
+
+    def is_running(self):
+        return self._main_profiler is not None
+
+    @contextlib.contextmanager
+    def running(self):
+        self.start()
+        try:
+            yield self
+        finally:
+            self.stop()
+
+    def get_summary(self):
+        with self._lock:
+            webdriver_wait = self._webdriver_ticks * self._sample_interval
+            ticks = self._ticks
+            cpu_time = max(self._cpu_time - self._sampling_time, 0)
+
+        return '\n'.join([
+            'Wall time: {:.3f}s'.format(self._wall_time),
+            'Python CPU time: {:.3f}s'.format(cpu_time),
+            'WebDriver wait: {:.3f}s'.format(webdriver_wait),
+            'Other waits: {:.3f}s'.format(
+                max(self._wall_time - cpu_time - webdriver_wait, 0)),
+            'Samples: {} every {}s'.format(ticks, self._sample_interval),
+        ]) + '\n'
+
+    def dump(self, prefix):
+        '''
+        Write the .pstats, .collapsed and .txt files and return their paths
+        '''
+        make_directory(os.path.dirname(prefix))
+
+        self._merge_finished_profiles()
+        with self._lock:
+            stacks = dict(self._stacks)
+
+        self._stats.dump_stats(prefix + '.pstats')
+
+        with open(prefix + '.collapsed', 'w') as file_:
+            for stack, count in sorted(stacks.items()):
+                file_.write('{} {}\n'.format(stack, count))
+
+        with open(prefix + '.txt', 'w') as file_:
+            file_.write(self.get_summary())
+
+        paths = [
+            prefix + suffix for suffix in ('.pstats', '.collapsed', '.txt')]
+        logging.info('Wrote profile to {}'.format(', '.join(paths)))
+
+        return paths
+
+
+def make_profile_prefix(directory, name):
+    return os.path.join(directory, '{}-{}-{}'.format(
+        name, datetime.datetime.now().strftime('%Y%m%d-%H%M%S'), os.getpid()))
@@ -0,0 +1,469 @@
+'''
+Record the pages a scheduler session goes through and play them back later
+without a network.
+
+While recording, every page the driver ends up on (after a get, a click or a
+form submit) and every frame it switches to is saved along with how long the
+action took. Identical pages are stored once. Playing back feeds the same
+pages, in the same order, to a CrossfitScheduler through ReplayDriver, which
+sleeps the recorded delays multiplied by `speed` (0 means no delays).
+
+The replay driver needs lxml to query the recorded pages.
+'''
+import os
+import json
+import gzip
+import time
+import hashlib
+import logging
+import datetime
+import tempfile
+import uuid
+
+from selenium.common.exceptions import NoSuchElementException
+
+from activities import Activity
+from helpers import make_directory
+
+
+_FORMAT_VERSION = 1
+
+
+def _serialize_arg(arg):
+    if isinstance(arg, Activity):
+        return arg.to_dict()
+
+    # e.g. the activities of cancel_many
+    if isinstance(arg, (list, tuple)):
+        return [_serialize_arg(item) for item in arg]
+
+    return arg
+
+
+def _deserialize_arg(arg):
+    if isinstance(arg, dict):
+        return Activity.from_dict(arg)
+
+    if isinstance(arg, list):
+        return [_deserialize_arg(item) for item in arg]
+
+    return arg
+
+
+class SessionRecorder(object):
+
+    def __init__(self, email):
+        self._email = email
+        self._operations = []
+        self._pages = {}
+        self._events = []
+        self._lookups = []
+
+    def start_operation(self, name, args):
+        self._operations.append({
+            'name': name,
+            'args': [_serialize_arg(arg) for arg in args],
+        })
+
+    def record(self, kind, url, source, started_at):
+        digest = hashlib.sha1(source.encode('utf-8')).hexdigest()
+        self._pages[digest] = source
+
+        self._events.append({
+            'kind': kind,
+            'url': url,
+            'page': digest,
+            'delay': time.time() - started_at,
+        })
+
+    def record_lookup(self, urls):
+        '''
+        Record the answer of the timetable service, which is asked instead of
+        loading the timetable pages
+        '''
+        self._lookups.append(urls)
+
+    def save(self, path):
+        directory = os.path.dirname(path)
+        make_directory(directory)
+
+        # Written next to the final path and renamed, so a failed save does
+        # not leave a truncated recording behind
+        fd, temp_path = tempfile.mkstemp(
+            dir=directory or '.', suffix='.tmp')
+        os.close(fd)
+        try:
+            with gzip.open(temp_path, 'wb') as file_:
+                json.dump({
+                    'version': _FORMAT_VERSION,
+                    'email': self._email,
+                    'recorded_at': time.time(),
+                    'operations': self._operations,
+                    'pages': self._pages,
+                    'events': self._events,
+                    'lookups': self._lookups,
+                }, file_)
+
+            os.rename(temp_path, path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+
+        logging.info('Saved session recording to {}'.format(path))
+
+
+def load_archive(path):
+    with gzip.open(path, 'rb') as file_:
+        archive = json.load(file_)
+
+    if archive.get('version') != _FORMAT_VERSION:
+        raise ValueError('Unsupported recording version {}'.format(
+            archive.get('version')))
+
+    return archive
+
+
+def make_recording_path(directory):
+    # Parallel schedulers start in the same second in the same process
+    return os.path.join(directory, '{}-{}-{}.json.gz'.format(
+        datetime.datetime.now().strftime('%Y%m%d-%H%M%S'), os.getpid(),
+        uuid.uuid4().hex[:8]))
+
+
+def _unwrap(element):
+    return getattr(element, '_element', element)
+
+
+class _RecordingSwitchTo(object):
+
+    def __init__(self, driver):
+        self._driver = driver
+
+    def frame(self, frame_reference):
+        started_at = time.time()
+        real = self._driver._driver
+        real.switch_to.frame(_unwrap(frame_reference))
+        self._driver._recorder.record(
+            'frame', real.current_url, real.page_source, started_at)
+
+    def default_content(self):
+        self._driver._driver.switch_to.default_content()
+
+
+class _RecordingElement(object):
+
+    def __init__(self, element, driver):
+        self._element = element
+        self._driver = driver
+
+    def __getattr__(self, name):
+        return getattr(self._element, name)
+
+    def _navigate(self, action):
+        started_at = time.time()
+        action()
+        self._driver._record_page(started_at)
+
+    def click(self):
+        self._navigate(self._element.click)
+
+    def submit(self):
+        self._navigate(self._element.submit)
+
+    def find_element_by_xpath(self, xpath):
+        return _RecordingElement(
+            self._element.find_element_by_xpath(xpath), self._driver)
+
+    def find_elements_by_xpath(self, xpath):
+        return [
+            _RecordingElement(element, self._driver)
+            for element in self._element.find_elements_by_xpath(xpath)
+        ]
+
+
+class RecordingDriver(object):
+    '''
+    Wraps a WebDriver and records every page it lands on
+    '''
+
+    def __init__(self, driver, recorder):
+        self._driver = driver
+        self._recorder = recorder
+        self.switch_to = _RecordingSwitchTo(self)
+
+    def __getattr__(self, name):
+        return getattr(self._driver, name)
+
+    def _record_page(self, started_at):
+        self._recorder.record(
+            'page', self._driver.current_url, self._driver.page_source,
+            started_at)
+
+    def get(self, url):
+        started_at = time.time()
+        self._driver.get(url)
+        self._record_page(started_at)
+
+    def _wrap(self, element):
+        return _RecordingElement(element, self)
+
+    def find_element_by_xpath(self, xpath):
+        return self._wrap(self._driver.find_element_by_xpath(xpath))
+
+    def find_elements_by_xpath(self, xpath):
+        return map(self._wrap, self._driver.find_elements_by_xpath(xpath))
+
+    def find_element_by_link_text(self, text):
+        return self._wrap(self._driver.find_element_by_link_text(text))
+
+    def find_element_by_id(self, id_):
+        return self._wrap(self._driver.find_element_by_id(id_))
+
+
+def _normalize_text(text):
+    return ' '.join(text.split())
+
+
+class _ReplayElement(object):
+
+    def __init__(self, node, driver):
+        self._node = node
+        self._driver = driver
+
+    @property
+    def tag_name(self):
+        return self._node.tag
+
+    @property
+    def text(self):
+        return _normalize_text(self._node.text_content())
+
+    def get_attribute(self, name):
+        if name == 'textContent':
+            return self._node.text_content()
+
+        return self._node.get(name)
+
+    def click(self):
+        self._driver._next_event('page')
+
+    def submit(self):
+        self._driver._next_event('page')
+
+    def send_keys(self, *values):
+        pass
+
+    def find_element_by_xpath(self, xpath):
+        return self._driver._find_one(self._node, xpath)
+
+    def find_elements_by_xpath(self, xpath):
+        return self._driver._find_all(self._node, xpath)
+
+
+class _ReplaySwitchTo(object):
+
+    def __init__(self, driver):
+        self._driver = driver
+
+    def frame(self, frame_reference):
+        self._driver._next_event('frame')
+
+    def default_content(self):
+        self._driver._document = self._driver._page
+
+
+class ReplayDriver(object):
+    '''
+    Stands in for a WebDriver, serving the pages of a recording in order.
+    Only implements what CrossfitScheduler uses.
+    '''
+
+    def __init__(self, archive, speed=1.0):
+        # Imported here so that recording does not need lxml
+        import lxml.html
+
+        self._parse = lxml.html.document_fromstring
+        self._archive = archive
+        self._events = iter(archive['events'])
+        self._speed = speed
+        self._page = None
+        self._document = None
+        self.current_url = None
+        self.switch_to = _ReplaySwitchTo(self)
+
+    def _next_event(self, kind):
+        try:
+            event = next(self._events)
+        except StopIteration:
+            raise ValueError(
+                'The session went further than the recording did')
+
+        if event['kind'] != kind:
+            raise ValueError(
+                'Expected a {} in the recording, found a {} for {}'.format(
+                    kind, event['kind'], event['url']))
+
+        if self._speed:
+            time.sleep(event['delay'] * self._speed)
+
+        document = self._parse(self._archive['pages'][event['page']])
+        document.make_links_absolute(event['url'], resolve_base_href=True)
+
+        self.current_url = event['url']
+        self._document = document
+        if kind == 'page':
+            self._page = document
+
+    def _find_all(self, node, xpath):
+        return [
+            _ReplayElement(element, self) for element in node.xpath(xpath)
+            if hasattr(element, 'tag')
+        ]
+
+    def _find_one(self, node, xpath):
+        elements = self._find_all(node, xpath)
+        if not elements:
+            raise NoSuchElementException(
+                'Unable to locate element: {}'.format(xpath))
+
+        return elements[0]
+
+    @property
+    def page_source(self):
+        import lxml.html
+
+        return lxml.html.tostring(self._document)
+
+    def get(self, url):
+        self._next_event('page')
+
+    def find_element_by_xpath(self, xpath):
+        return self._find_one(self._document, xpath)
+
+    def find_elements_by_xpath(self, xpath):
+        return self._find_all(self._document, xpath)
+
+    def find_element_by_link_text(self, text):
+        for element in self._find_all(self._document, '//a'):
+            if element.text == text:
+                return element
+
+        raise NoSuchElementException(
+            'Unable to locate link with text: {}'.format(text))
+
+    def find_element_by_id(self, id_):
+        return self._find_one(self._document, "//*[@id='{}']".format(id_))
+
+    def execute_script(self, script, *args):
+        pass
+
+    def set_page_load_timeout(self, timeout):
+        pass
+
+    def set_script_timeout(self, timeout):
+        pass
+
+    def implicitly_wait(self, timeout):
+        pass
+
+    def close(self):
+        pass
+
+    def quit(self):
+        pass
+
+
+class _ReplayTimetableClient(object):
+    '''
+    Answers with what the timetable service answered while recording
+    '''
+
+    def __init__(self, lookups):
+        self._lookups = iter(lookups)
+
+    def lookup(self, activity):
+        try:
+            return next(self._lookups)
+        except StopIteration:
+            raise ValueError(
+                'The session asked the timetable service more than the '
+                'recording did')
+
+
+class _NoCircuitBreaker(object):
+    '''
+    Replays must not trip or be stopped by the breaker of the live site
+    '''
+
+    def raise_if_open(self):
+        pass
+
+    def guard(self):
+        return _NullContext()
+
+
+class _NoRateLimiter(object):
+    '''
+    Replays do not talk to the site, `speed` decides how fast they go
+    '''
+
+    def acquire(self, kind):
+        return 0.0
+
+
+class _NoFillHistory(object):
+    '''
+    Replays must not add to the history of the live timetable
+    '''
+
+    def record_scrape(self, activities):
+        pass
+
+    def record_attempt(self, activity, outcome):
+        pass
+
+
+class _NullContext(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+def replay(path, speed=1.0):
+    '''
+    Run the operations of a recording against its pages. Return a list of
+    (operation name, result or exception, seconds taken) tuples.
+    '''
+    from scheduler import CrossfitScheduler
+
+    archive = load_archive(path)
+
+    scheduler = CrossfitScheduler(
+        archive['email'],
+        driver_factory=lambda: ReplayDriver(archive, speed),
+        circuit_breaker=_NoCircuitBreaker(),
+        rate_limiter=_NoRateLimiter(),
+        fill_history=_NoFillHistory(),
+        timetable_client=(
+            _ReplayTimetableClient(archive['lookups'])
+            if archive.get('lookups') else None),
+        record=False)
+
+    results = []
+    with scheduler:
+        for operation in archive['operations']:
+            args = [_deserialize_arg(arg) for arg in operation['args']]
+
+            started_at = time.time()
+            try:
+                result = getattr(scheduler, operation['name'])(*args)
+            except Exception, e:
+                result = e
+
+            results.append(
+                (operation['name'], result, time.time() - started_at))
+
+    return results
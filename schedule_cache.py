@@ -0,0 +1,78 @@
+import os
+import time
+
+import settings
+from activities import Activity
+from helpers import locked_json_file, read_locked_json_file
+
+
+_DEFAULT_CACHE_FILE = os.path.join(
+    os.getenv('HOME'), '.gym_sub', 'active_schedules.json')
+
+
+class ActiveSchedulesCache(object):
+    '''
+    Active schedules per email, so that listing them does not need a browser
+    session every time.
+
+    Successful schedules and cancellations are written through to the cache
+    as they happen; a full scrape replaces an email's entries and resets its
+    age. Entries older than `ttl` seconds are considered stale.
+    '''
+
+    def __init__(self, cache_file=None, ttl=None):
+        self._cache_file = cache_file or _DEFAULT_CACHE_FILE
+        self._ttl = ttl or settings.ACTIVE_SCHEDULES_TTL
+
+    def _locked_cache(self):
+        return locked_json_file(self._cache_file, dict)
+
+    def _read_cache(self):
+        return read_locked_json_file(self._cache_file, dict)
+
+    def get(self, email):
+        '''
+        Return the cached schedules or None if there are none or they are
+        stale
+        '''
+        entry = self._read_cache().get(email)
+
+        if entry is None or time.time() - entry['fetched_at'] > self._ttl:
+            return None
+
+        return [
+            Activity.from_dict(schedule) for schedule in entry['schedules']]
+
+    def set(self, email, schedules):
+        with self._locked_cache() as cache:
+            cache[email] = {
+                'fetched_at': time.time(),
+                'schedules': [schedule.to_dict() for schedule in schedules],
+            }
+
+    def add(self, email, activity):
+        with self._locked_cache() as cache:
+            # Without a full scrape we would be caching a partial list
+            if email not in cache:
+                return
+
+            schedules = cache[email]['schedules']
+            if activity not in set(map(Activity.from_dict, schedules)):
+                schedules.append(activity.to_dict())
+
+    def remove(self, email, activity):
+        with self._locked_cache() as cache:
+            if email not in cache:
+                return
+
+            cache[email]['schedules'] = [
+                schedule for schedule in cache[email]['schedules']
+                if Activity.from_dict(schedule) != activity
+            ]
+
+    def get_stale_emails(self):
+        now = time.time()
+        return [
+            email for email, entry in self._read_cache().items()
+            if now - entry['fetched_at'] > self._ttl
+        ]
@@ -1,34 +1,125 @@
 import datetime
 import urlparse
+import functools
 import logging
+import socket
 import re
 
 from selenium import webdriver
 from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
-from selenium.common.exceptions import NoSuchElementException
+from selenium.common.exceptions import (
+    NoSuchElementException, StaleElementReferenceException, TimeoutException)
 
+import settings
+from activities import Activities, Activity
+from circuit_breaker import CircuitBreaker
+from driver_supervisor import get_supervisor
+from fill_history import FillHistory
+from helpers import OperationTimeoutError, run_with_timeout
+from replay import RecordingDriver, SessionRecorder, make_recording_path
+from site_rate_limiter import SiteRateLimiter, get_rate_limiter
+from timetable_service import TimetableClient, TimetableUnavailableError
 
-logging.basicConfig(filename='gym.log', level=logging.INFO)
+
+# We're looking for something like this: "bla bla 07:00-08:00"
+_INFO_TIME_RE = re.compile(
+    r'.*(?P<hour>\d\d):(?P<minute>\d\d)-\d\d:\d\d$')
+
+
+# Errors that mean the site (or the browser talking to it) is not responding,
+# as opposed to the site answering with something we did not expect
+SITE_FAILURES = (
+    TimeoutException, OperationTimeoutError, socket.error)
+
+
+def _guarded(method):
+    '''
+    Run the method through the site circuit breaker
+    '''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self._recycle_driver_if_needed()
+
+        if self._recorder is not None:
+            self._recorder.start_operation(method.__name__, args)
+
+        outer_call = self._guarded_call
+        with self._circuit_breaker.guard() as call:
+            self._guarded_call = call
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self._guarded_call = outer_call
+
+    return wrapper
+
+
+def _make_phantomjs_driver():
+    user_agent = (
+        'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_8_4) '
+        'AppleWebKit/537.36 (KHTML, like Gecko) Chrome/29.0.1547.57 '
+        'Safari/537.36'
+    )
+    dcap = dict(DesiredCapabilities.PHANTOMJS)
+    dcap["phantomjs.page.settings.userAgent"] = user_agent
+
+    return webdriver.PhantomJS(desired_capabilities=dcap)
+
+
+def _make_timetable_client():
+    if settings.TIMETABLE_SERVICE_URL is None:
+        return None
+
+    return TimetableClient(settings.TIMETABLE_SERVICE_URL)
 
 
 class CrossfitScheduler(object):
 
     MAX_HOURS_BEFORE_NOTICE = 18
 
-    class Activities:
-        CROSSFIT = 'Crossfit'
-        TRX = 'Trx'
-        FREESTYLE = 'Freestyle'
-        METABOLIC = 'Metabolic'
-        PILATES = 'Pilates'
-        YOGA = 'Yoga'
-        XTREME = 'Xtreme'
-        INSANITY = 'Insanity'
+    Activities = Activities
 
     def __init__(self, email, *args, **kwargs):
         self._email = email
 
+        # In seconds
+        self._driver_start_timeout = kwargs.get(
+            'driver_start_timeout', settings.DRIVER_START_TIMEOUT)
+        self._page_load_timeout = kwargs.get(
+            'page_load_timeout', settings.PAGE_LOAD_TIMEOUT)
+        self._script_timeout = kwargs.get(
+            'script_timeout', settings.SCRIPT_TIMEOUT)
+        self._implicit_wait = kwargs.get(
+            'implicit_wait', settings.IMPLICIT_WAIT)
+        self._login_timeout = kwargs.get(
+            'login_timeout', settings.LOGIN_TIMEOUT)
+        self._click_timeout = kwargs.get(
+            'click_timeout', settings.CLICK_TIMEOUT)
+
+        self._circuit_breaker = kwargs.get(
+            'circuit_breaker',
+            CircuitBreaker(failure_exceptions=SITE_FAILURES))
+        self._supervisor = kwargs.get('supervisor', get_supervisor())
+        self._driver_factory = kwargs.get(
+            'driver_factory', _make_phantomjs_driver)
+        self._fill_history = kwargs.get('fill_history', FillHistory())
+        self._timetable_client = kwargs.get(
+            'timetable_client', _make_timetable_client())
+        self._rate_limiter = kwargs.get('rate_limiter', get_rate_limiter())
+        # What the circuit breaker makes of the guarded call we are in
+        self._guarded_call = None
+
+        # Record the pages of the session so it can be replayed offline
+        self._recorder = None
+        self._recording_path = None
+        if kwargs.get('record', settings.RECORDINGS_DIR is not None):
+            self._recorder = SessionRecorder(email)
+            self._recording_path = make_recording_path(
+                settings.RECORDINGS_DIR)
+
     def __enter__(self):
+        # No point in starting a browser if we already know the site is down
+        self._circuit_breaker.raise_if_open()
         self._init_driver()
         return self
 
@@ -36,19 +127,58 @@ class CrossfitScheduler(object):
         self._dispose_of_driver()
 
     def _init_driver(self):
-        user_agent = (
-            'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_8_4) '
-            'AppleWebKit/537.36 (KHTML, like Gecko) Chrome/29.0.1547.57 '
-            'Safari/537.36'
-        )
-        dcap = dict(DesiredCapabilities.PHANTOMJS)
-        dcap["phantomjs.page.settings.userAgent"] = user_agent
+        def start_driver():
+            driver = self._driver_factory()
+            # Registered from here so that a driver that comes up after we
+            # gave up waiting is still accounted for and eventually reaped
+            self._supervisor.register(driver)
+            return driver
+
+        self._driver = run_with_timeout(
+            self._driver_start_timeout, start_driver)
 
-        self._driver = webdriver.PhantomJS(desired_capabilities=dcap)
+        if self._recorder is not None:
+            self._driver = RecordingDriver(self._driver, self._recorder)
+
+        try:
+            self._driver.set_page_load_timeout(self._page_load_timeout)
+            self._driver.set_script_timeout(self._script_timeout)
+            self._driver.implicitly_wait(self._implicit_wait)
+        except Exception:
+            self._dispose_of_driver()
+            raise
+
+    def _get(self, url, kind):
+        self._rate_limiter.acquire(kind)
+        self._driver.get(url)
+
+    def _click(self, element, kind):
+        # Waiting for our turn does not count towards the click timeout
+        self._rate_limiter.acquire(kind)
+        run_with_timeout(self._click_timeout, element.click)
 
     def _dispose_of_driver(self):
-        self._driver.close()
-        self._driver.quit()
+        if self._recorder is not None:
+            try:
+                self._recorder.save(self._recording_path)
+            except Exception, e:
+                logging.error('Could not save recording: {}'.format(e))
+
+        try:
+            self._driver.close()
+        except Exception, e:
+            logging.error('Could not close driver: {}'.format(e))
+        finally:
+            try:
+                self._driver.quit()
+            finally:
+                self._supervisor.release(self._driver)
+
+    def _recycle_driver_if_needed(self):
+        if self._supervisor.is_over_memory_limit(self._driver):
+            logging.info('Driver is over the memory limit, recycling it')
+            self._dispose_of_driver()
+            self._init_driver()
 
     def start_driver(self):
         self._init_driver()
@@ -96,11 +226,10 @@ class CrossfitScheduler(object):
 
     def _get_all_activities(self):
         '''
-        Return a list of dictionaries that represents all the active
-        activities.
+        Return a dictionary mapping every active Activity to the list of
+        urls it can be scheduled at (there should only be one).
         '''
         def get_from_from_table():
-            activities = []
             valid_table_cells = self._driver.find_elements_by_xpath(
                 "//td[.//a[contains(@href, 'programari')]]")
 
@@ -109,12 +238,11 @@ class CrossfitScheduler(object):
 
                 for data in raw_data:
                     logging.info('Making activity with data {}'.format(data))
-                    activities.append(self._make_activity(data))
-
-            return activities
+                    activity, url = self._make_activity(data)
+                    activities.setdefault(activity, []).append(url)
 
         logging.info('Getting all schedule-able activities')
-        activities = []
+        activities = {}
 
         # Next week button
         next_week_but = self._driver.find_element_by_link_text('Umatoare')
@@ -122,19 +250,50 @@ class CrossfitScheduler(object):
         # We have to switch to the iframe so we can access the table
         self._driver.switch_to.frame(
             self._driver.find_element_by_id('changer2'))
-        activities.extend(get_from_from_table())
+        get_from_from_table()
 
         # Go to next week
         self._driver.switch_to.default_content()
-        next_week_but.click()
+        self._click(next_week_but, SiteRateLimiter.READ)
 
         # Switch back to the frame
         self._driver.switch_to.frame(
             self._driver.find_element_by_id('changer2'))
-        activities.extend(get_from_from_table())
+        get_from_from_table()
 
         return activities
 
+    def _scrape_timetable(self):
+        self._go_to_schedule_page()
+        activities = self._get_all_activities()
+        self._record_history('record_scrape', activities.keys())
+
+        return activities
+
+    def _find_activity_urls(self, activity):
+        '''
+        Return the urls for scheduling the activity, from the timetable
+        service if it has them, from the site otherwise
+        '''
+        if self._timetable_client is not None:
+            try:
+                urls = self._timetable_client.lookup(activity)
+            except TimetableUnavailableError, e:
+                logging.error(
+                    'Scraping the timetable ourselves: {}'.format(e))
+            else:
+                if self._recorder is not None:
+                    self._recorder.record_lookup(urls)
+                if urls:
+                    return urls
+
+                # The service can be a couple of refreshes behind, and a
+                # class that just opened is exactly the one we must not miss
+                logging.info(
+                    'Not in the timetable service, checking the site')
+
+        return self._scrape_timetable().get(activity)
+
     def _get_date_from_url_element(self, url_element):
         '''
         Url example:
@@ -158,28 +317,33 @@ class CrossfitScheduler(object):
         info_text = info_element.get_attribute('textContent')
         logging.info('Extracting start time from info "{}"'.format(info_text))
 
-        # We're looking for something like this: "bla bla 07:00-08:00"
-        time = re.match(
-            '.*(?P<start>\d\d:\d\d)-(?P<end>\d\d:\d\d)$', info_text)
+        time = _INFO_TIME_RE.match(info_text)
 
-        start = time.group('start')
-        hour, minute = start.split(':')
+        hour, minute = time.group('hour'), time.group('minute')
         logging.info('Got start hour {} and minute {}'.format(hour, minute))
 
         return int(hour), int(minute)
 
     def _make_activity(self, data):
-        activity = {
-            'activity': data[0].text.strip(),
-            'url': data[1].get_attribute('href'),
-            'date': self._get_date_from_url_element(data[1]),
-            'time': self._get_start_hour_from_info_element(data[2]),
-        }
-        logging.info('Created activity {}'.format(activity))
+        '''
+        Return the activity and the url for scheduling it
+        '''
+        date = self._get_date_from_url_element(data[1])
+        hour, minute = self._get_start_hour_from_info_element(data[2])
+
+        activity = Activity(
+            data[0].text.strip(),
+            datetime.datetime(date.year, date.month, date.day, hour, minute))
+        url = data[1].get_attribute('href')
+        logging.info('Created activity {} with url {}'.format(activity, url))
 
-        return activity
+        return activity, url
 
-    def _login(self):
+    def _login(self, kind):
+        self._rate_limiter.acquire(kind)
+        run_with_timeout(self._login_timeout, self._do_login)
+
+    def _do_login(self):
         logging.info('Starting login')
         form = self._driver.find_element_by_xpath('//form')
         email_input = form.find_element_by_xpath(
@@ -211,47 +375,86 @@ class CrossfitScheduler(object):
             "window.confirm = function(){ return true; }")
         logging.info('Finishing schedule')
 
-        schedule_button.click()
+        self._click(schedule_button, SiteRateLimiter.BOOKING)
 
-    def _schedule(self, activity):
+    def _schedule(self, activity, url):
         logging.info('Trying to schedule for activity {}'.format(activity))
 
-        self._driver.get(activity['url'])
-        self._login()
+        self._get(url, SiteRateLimiter.BOOKING)
+        self._login(SiteRateLimiter.BOOKING)
         schedule_button = self._get_schedule_button()
 
         if schedule_button is None:
             logging.info('NO POSITIONS LEFT')
+            self._record_history(
+                'record_attempt', activity, FillHistory.FULL)
             raise ValueError('There is no open positions for selected options')
 
         self._finish_scheduling(schedule_button)
 
         logging.info(
             'Successfully scheduled for activity {}'.format(activity))
+        self._record_history('record_attempt', activity, FillHistory.SUCCESS)
 
         return True
 
+    def _record_history(self, method_name, *args):
+        # The history is a nice to have, it must never get in the way of
+        # booking
+        try:
+            getattr(self._fill_history, method_name)(*args)
+        except Exception, e:
+            logging.error('Could not record fill history: {}'.format(e))
+
     def _go_to_schedule_page(self):
-        self._driver.get(
-            'http://89.137.4.84/site/Extern.php?sectiune=program')
+        self._get(
+            'http://89.137.4.84/site/Extern.php?sectiune=program',
+            SiteRateLimiter.READ)
 
     def _go_to_created_schedules_page(self):
         logging.info('Going to active schedules page')
 
-        self._driver.get('http://89.137.4.84/')
-        self._login()
+        self._get('http://89.137.4.84/', SiteRateLimiter.READ)
+        self._login(SiteRateLimiter.READ)
+
+        self._follow_schedules_link()
 
+    def _follow_schedules_link(self):
         schedules_link = self._driver.find_element_by_xpath(
             "//a[contains(@href, 'sectiune=programari')]")
-        schedules_link.click()
+        self._click(schedules_link, SiteRateLimiter.READ)
 
     def _get_active_created_schedules(self):
-        EXPECTED_NUMBER_OF_COLUMNS = 8
-
+        '''
+        Return a list of (Activity, cancel button) tuples
+        '''
         logging.info('Getting a list of active schedules')
 
         self._go_to_created_schedules_page()
 
+        return self._read_active_schedules()
+
+    def _reload_active_schedules(self):
+        '''
+        Read the schedules again after the page changed (e.g. after a cancel)
+        without logging in again if we are still logged in
+        '''
+        logging.info('Reloading the list of active schedules')
+
+        try:
+            self._follow_schedules_link()
+        except NoSuchElementException:
+            self._go_to_created_schedules_page()
+
+        return self._read_active_schedules()
+
+    def _read_active_schedules(self):
+        '''
+        Return a list of (Activity, cancel button) tuples from the schedules
+        page we are on
+        '''
+        EXPECTED_NUMBER_OF_COLUMNS = 8
+
         active_schedules = []
         try:
             table = self._driver.find_element_by_xpath(
@@ -273,49 +476,44 @@ class CrossfitScheduler(object):
             if 'Activa' not in last_element.text:
                 continue
 
-            hour, minute = elements[4].text.split(':')
             cancel_but = last_element.find_element_by_xpath('.//a')
-            active_schedules.append({
-                'activity': elements[0].text,
-                'date': datetime.datetime.strptime(
-                    elements[3].text, '%Y-%m-%d').date(),
-                'time': (int(hour), int(minute)),
-                'cancel_but': cancel_but
-            })
+            activity = Activity(
+                elements[0].text,
+                datetime.datetime.strptime(
+                    '{} {}'.format(elements[3].text, elements[4].text),
+                    '%Y-%m-%d %H:%M'))
+            active_schedules.append((activity, cancel_but))
 
         return active_schedules
 
+    @_guarded
     def get_active_schedules(self):
-        schedules = self._get_active_created_schedules()
-
-        for schedule in schedules:
-            schedule.pop('cancel_but')
+        return [
+            activity
+            for activity, _ in self._get_active_created_schedules()
+        ]
 
-        return schedules
-
-    def _finish_cancelling(self, schedule):
+    def _finish_cancelling(self, activity, cancel_button):
         # Hackish so that every confirm is true so we don't have to
         # deal with pressing OK
         self._driver.execute_script(
             "window.confirm = function(){ return true; }")
 
-        schedule['cancel_but'].click()
+        self._click(cancel_button, SiteRateLimiter.BOOKING)
 
-        logging.info('Canceled schedule {}'.format(schedule))
+        logging.info('Canceled schedule {}'.format(activity))
 
-    def _raise_if_should_be_visible(self, activity_name, date, time):
+    def _raise_if_should_be_visible(self, activity):
         max_time = datetime.timedelta(hours=self.MAX_HOURS_BEFORE_NOTICE)
-        activity_date_time = datetime.datetime(
-            date.year, date.month, date.day, time[0], time[1])
 
-        if activity_date_time - datetime.datetime.now() < max_time:
+        if activity.date_time - datetime.datetime.now() < max_time:
             raise ValueError(
                 'No activity in the next 24 hours with details: '
-                'Name: {} Date: {} Hour: {}:{}'.format(
-                    activity_name, date, *time)
+                '{}'.format(activity)
             )
 
-    def schedule(self, activity_name, date, time):
+    @_guarded
+    def schedule(self, activity):
         '''
         Return true if activity is programmable and schedule is successful
         and false otherwise (i.e. it does not find an activity that is
@@ -329,77 +527,142 @@ class CrossfitScheduler(object):
               find an activity matching the given details
 
         ** activity
-            The name of the activity you want to make a schedule to
-        ** time
-            A tuple with two values, the first one being the hour (in 24 hour
-            format) and the second the minute
-        ** date
-            A date which has specified only year, month and date
+            The Activity you want to make a schedule to
         '''
-        def activity_matches(activity):
-            return all([
-                activity['activity'].lower() == activity_name.lower(),
-                activity['time'] == time,
-                activity['date'] == date,
-            ])
-
         logging.info(
-            'Searching for activity with search params -'
-            ' Name: {}, Date: {}, Time: {}:{}'.format(
-                activity_name, date, *time)
-        )
+            'Searching for activity with search params - {}'.format(activity))
 
-        self._go_to_schedule_page()
-        activities = self._get_all_activities()
-        activity = filter(activity_matches, activities)
+        urls = self._find_activity_urls(activity)
 
-        if not activity:
-            self._raise_if_should_be_visible(activity_name, date, time)
+        if not urls:
+            self._record_history(
+                'record_attempt', activity, FillHistory.NOT_VISIBLE)
+            self._raise_if_should_be_visible(activity)
             logging.info('No activity found')
             return False
 
-        if len(activity) > 1:
+        if len(urls) > 1:
             logging.error(
                 'Weird. There are more than one activities for given search '
                 'params. That should not happen. Aborting. '
-                'Details: {}'.format(activity)
+                'Details: {}'.format(urls)
             )
             raise ValueError(
                 'There should not be more activities for single search')
 
-        succeessful = self._schedule(activity[0])
+        succeessful = self._schedule(activity, urls[0])
 
         return succeessful
 
-    def cancel_schedule(self, activity_name, date, time):
-        def schedule_matches(schedule):
-            return all([
-                schedule['activity'].lower() == activity_name.lower(),
-                schedule['time'] == time,
-                schedule['date'] == date,
-            ])
+    @_guarded
+    def get_timetable(self):
+        '''
+        Return a dictionary mapping every Activity that can be scheduled to
+        the urls for scheduling it, as scraped from the site
+        '''
+        return self._scrape_timetable()
 
-        logging.info(
-            'Trying to cancel schedule with '
-            'Name: {}, Date: {}, Time: {}:{}'.format(
-                activity_name, date, *time)
-        )
+    @_guarded
+    def cancel_schedule(self, activity):
+        _, error = self._cancel_many([activity])[0]
 
-        active_schedules = self._get_active_created_schedules()
-        schedule = filter(schedule_matches, active_schedules)
+        if error is not None:
+            raise error
 
-        if not schedule:
-            raise ValueError('No schedules found for given options')
+        return True
 
-        if len(schedule) > 1:
-            logging.error(
-                'Weird. There are more than one schedules for given search '
-                'params. That should not happen. Aborting'
-                'Details: {}'.format(schedule)
-            )
-            raise ValueError(
-                'There should not be more than one schedule for a search')
+    @_guarded
+    def cancel_many(self, activities):
+        '''
+        Cancel all the given activities with a single login. Return a list of
+        (activity, error) tuples in the same order as the activities, where
+        error is None if the activity was cancelled and the exception that
+        stopped it otherwise. Raises if the site fails before any activity
+        got cancelled.
+        '''
+        return self._cancel_many(activities)
 
-        self._finish_cancelling(schedule[0])
+    def _cancel_many(self, activities):
+        def index_cancel_buttons(schedules):
+            cancel_buttons = {}
+            for schedule, cancel_button in schedules:
+                cancel_buttons.setdefault(schedule, []).append(cancel_button)
 
-        return True
+            return cancel_buttons
+
+        def find_cancel_button(activity):
+            buttons = cancel_buttons.get(activity)
+
+            if not buttons:
+                raise ValueError(
+                    'No schedules found for {}'.format(activity))
+
+            if len(buttons) > 1:
+                logging.error(
+                    'Weird. There are more than one schedules for given '
+                    'search params. That should not happen. Aborting'
+                    'Details: {}'.format(activity)
+                )
+                raise ValueError(
+                    'There should not be more than one schedule for a search')
+
+            return buttons[0]
+
+        logging.info('Trying to cancel schedules {}'.format(activities))
+
+        cancel_buttons = index_cancel_buttons(
+            self._get_active_created_schedules())
+
+        results = []
+        # Set when we cannot go on with the rest, e.g. the site is down
+        stopped_by = None
+        for activity in activities:
+            if stopped_by is not None:
+                results.append((activity, stopped_by))
+                continue
+
+            try:
+                cancel_button = find_cancel_button(activity)
+            except ValueError, e:
+                results.append((activity, e))
+                continue
+
+            try:
+                try:
+                    self._finish_cancelling(activity, cancel_button)
+                except StaleElementReferenceException:
+                    # Something changed the page under us, read it again and
+                    # give it one more try
+                    cancel_buttons = index_cancel_buttons(
+                        self._reload_active_schedules())
+                    self._finish_cancelling(
+                        activity, find_cancel_button(activity))
+            except SITE_FAILURES, e:
+                stopped_by = e
+                results.append((activity, e))
+                continue
+            except Exception, e:
+                results.append((activity, e))
+            else:
+                results.append((activity, None))
+
+            # Cancelling loads another page, so the buttons we have are stale
+            if len(results) < len(activities):
+                try:
+                    cancel_buttons = index_cancel_buttons(
+                        self._reload_active_schedules())
+                except Exception, e:
+                    stopped_by = e
+
+        # Nothing to lose by raising when nothing got cancelled, and the
+        # circuit breaker gets to count the failure
+        if isinstance(stopped_by, SITE_FAILURES) and all(
+                error is not None for _, error in results):
+            raise stopped_by
+
+        # Some got cancelled but the site still failed, that is no success
+        if (isinstance(stopped_by, SITE_FAILURES) and
+                self._guarded_call is not None):
+            self._guarded_call.fail()
+
+        return results
@@ -1,2 +1,56 @@
 EMAIL = ''
 SLACK_TOKEN = ''
+
+# Timeouts for interactions with the gym's site, in seconds
+DRIVER_START_TIMEOUT = 30
+PAGE_LOAD_TIMEOUT = 30
+SCRIPT_TIMEOUT = 10
+IMPLICIT_WAIT = 0
+LOGIN_TIMEOUT = 45
+CLICK_TIMEOUT = 30
+
+# Consecutive site failures after which we stop trying for a while
+CIRCUIT_FAILURE_THRESHOLD = 3
+# In seconds
+CIRCUIT_RESET_TIMEOUT = 300
+
+# Drivers using more than this are replaced between operations
+DRIVER_MAX_RSS_MB = 300
+# Drivers older than this are considered leaked and killed, in seconds
+DRIVER_MAX_AGE = 1800
+
+# Requests per second to the gym site, shared by every process on this host.
+# Bookings have their own budget and go first
+SITE_READ_RATE = 1
+SITE_BOOKING_RATE = 2
+
+# How long the cached active schedules of a user are trusted, in seconds
+ACTIVE_SCHEDULES_TTL = 3600
+
+# If set, every scheduler session is recorded in this directory and can be
+# replayed with `gym_sub replay`
+RECORDINGS_DIR = None
+
+# Where `gym_sub --profile` and the slack bot write their profiles and memory
+# reports
+PROFILES_DIR = 'profiles'
+
+# Minutes between two memory snapshots of the slack bot. None disables them
+MEMORY_DIAGNOSTICS_INTERVAL = None
+# Memory growth after which the owner gets a report of what grew
+MEMORY_GROWTH_THRESHOLD_MB = 100
+
+# Port for the slack bot's Prometheus metrics, on localhost. None disables it
+METRICS_PORT = 9105
+
+# How long before a class starts the gym lets you book it. Stored activities
+# are not looked up on the site before that
+BOOKING_WINDOW_HOURS = 24
+
+# Port `gym_sub serve_timetable` listens on, on localhost
+TIMETABLE_SERVICE_PORT = 9106
+# Url of a running timetable service, e.g. 'http://127.0.0.1:9106'. When set,
+# schedulers look classes up there instead of scraping the timetable
+TIMETABLE_SERVICE_URL = None
+# How often the timetable service scrapes the timetable, in seconds
+TIMETABLE_REFRESH_INTERVAL = 300
@@ -16,6 +16,9 @@ setup(
         "wheel==0.24.0",
 
     ],
+    extras_require={
+        'replay': ['lxml'],
+    },
     entry_points='''
         [console_scripts]
         gym_sub=clients.cli:cli
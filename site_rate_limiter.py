@@ -0,0 +1,143 @@
+import os
+import time
+import logging
+import threading
+
+import settings
+from helpers import locked_json_file
+
+
+_DEFAULT_STATE_FILE = os.path.join(
+    os.getenv('HOME'), '.gym_sub', 'rate_limit.json')
+
+# A waiting booking that has not checked in for this long belongs to a
+# process that died, in seconds
+_WAITER_EXPIRY = 10
+# How often reads check whether the bookings are done waiting, in seconds
+_YIELD_INTERVAL = 0.1
+# Waits longer than this are logged, in seconds
+_LOG_WAIT_OVER = 1
+
+
+class SiteRateLimiter(object):
+    '''
+    Token buckets for the requests we make to the gym site, shared by every
+    thread and process on this host.
+
+    Timetable reads and bookings have separate buckets so a burst of reads
+    cannot use up the requests a booking needs. On top of that bookings have
+    priority: while a booking is waiting for a token no read gets one.
+
+    The buckets live in a file so that the slack bot and every `gym_sub`
+    process it spawns share them.
+    '''
+
+    READ = 'read'
+    BOOKING = 'booking'
+
+    def __init__(self, state_file=None, rates=None, capacity=2):
+        self._state_file = state_file or _DEFAULT_STATE_FILE
+        self._rates = rates or {
+            self.READ: float(settings.SITE_READ_RATE),
+            self.BOOKING: float(settings.SITE_BOOKING_RATE),
+        }
+        self._capacity = float(capacity)
+
+        self._stats_lock = threading.Lock()
+        self._stats = dict(
+            (kind, {'acquired': 0, 'waited': 0.0}) for kind in self._rates)
+
+    def _initial_state(self):
+        return {
+            'buckets': dict(
+                (kind, {'tokens': self._capacity, 'last_refill': time.time()})
+                for kind in self._rates
+            ),
+            'waiting_bookings': {},
+        }
+
+    def _locked_state(self):
+        return locked_json_file(self._state_file, self._initial_state)
+
+    def _refill(self, bucket, rate, now):
+        elapsed = max(now - bucket['last_refill'], 0)
+        bucket['tokens'] = min(
+            self._capacity, bucket['tokens'] + elapsed * rate)
+        bucket['last_refill'] = now
+
+    def _try_acquire(self, kind, waiter_id):
+        '''
+        Take a token if we may. Return 0 if we got one or the number of
+        seconds to wait before trying again.
+        '''
+        now = time.time()
+        with self._locked_state() as state:
+            waiting = state['waiting_bookings']
+            for other_id, checked_in_at in waiting.items():
+                if now - checked_in_at > _WAITER_EXPIRY:
+                    del waiting[other_id]
+
+            if kind == self.READ and waiting:
+                return _YIELD_INTERVAL
+
+            bucket = state['buckets'].setdefault(
+                kind, {'tokens': self._capacity, 'last_refill': now})
+            self._refill(bucket, self._rates[kind], now)
+
+            if bucket['tokens'] >= 1:
+                bucket['tokens'] -= 1
+                waiting.pop(waiter_id, None)
+                return 0
+
+            if kind == self.BOOKING:
+                waiting[waiter_id] = now
+
+            return (1 - bucket['tokens']) / self._rates[kind]
+
+    def acquire(self, kind):
+        '''
+        Wait until we may make a request of the given kind. Return the number
+        of seconds spent waiting.
+        '''
+        waiter_id = '{}-{}'.format(
+            os.getpid(), threading.current_thread().ident)
+
+        waited = 0.0
+        while True:
+            wait = self._try_acquire(kind, waiter_id)
+            if not wait:
+                break
+
+            time.sleep(wait)
+            waited += wait
+
+        with self._stats_lock:
+            self._stats[kind]['acquired'] += 1
+            self._stats[kind]['waited'] += waited
+
+        if waited > _LOG_WAIT_OVER:
+            logging.info('Waited {:.1f} seconds to make a {} request'.format(
+                waited, kind))
+
+        return waited
+
+    def get_stats(self):
+        '''
+        Return a dictionary mapping each kind of request to the number of
+        requests this process made and the seconds it spent waiting for them
+        '''
+        with self._stats_lock:
+            return dict(
+                (kind, dict(stats)) for kind, stats in self._stats.items())
+
+
+_RATE_LIMITER = None
+
+
+def get_rate_limiter():
+    global _RATE_LIMITER
+
+    if _RATE_LIMITER is None:
+        _RATE_LIMITER = SiteRateLimiter()
+
+    return _RATE_LIMITER
@@ -0,0 +1,149 @@
+'''
+Measures how many messages the slack bot can answer and how fast, against
+clients.fake_slack instead of the real Slack.
+
+Random members of a fake workspace send the bot direct messages at `rate`
+per second for `duration` seconds. Every message is matched with its answer
+to get the end to end latency; messages without an answer `timeout` seconds
+after the last one was sent are counted as dropped. The periodic jobs are
+turned off so nothing talks to the gym site.
+
+Usage:
+    python slack_load_test.py --users 200 --rate 2 --duration 60
+'''
+import re
+import math
+import time
+import random
+import threading
+
+import click
+
+from clients import slack_client
+from clients.fake_slack import FakeSlack
+
+
+_MESSAGE_TEXT = 'load_test {}'
+_MESSAGE_RE = re.compile(r'load_test (?P<sequence>\d+)')
+
+
+def _percentile(values, percent):
+    '''
+    Nearest rank percentile of the sorted values
+    '''
+    index = int(math.ceil(percent / 100.0 * len(values))) - 1
+    return values[min(max(index, 0), len(values) - 1)]
+
+
+def _make_command_runner(command_time, spawn):
+    def run_command(arguments):
+        if spawn:
+            # Pay for starting a real gym_sub like every message does
+            slack_client.run_gym_sub('--help')
+
+        time.sleep(command_time)
+
+        return arguments
+
+    return run_command
+
+
+def run_load_test(users, rate, duration, timeout, command_time=0,
+                  spawn=False, api_latency=0):
+    '''
+    Return a dictionary with the number of messages sent, answered and
+    dropped, the sorted latencies of the answered ones, and the Web API
+    calls made by method.
+    '''
+    sent_at = {}
+    answered_at = {}
+    lock = threading.Lock()
+
+    def on_post(channel, text):
+        match = _MESSAGE_RE.search(text)
+        if match is not None:
+            with lock:
+                answered_at.setdefault(
+                    int(match.group('sequence')), time.time())
+
+    slack = FakeSlack(users=users, api_latency=api_latency, on_post=on_post)
+    slack_client.configure(
+        slack, command_runner=_make_command_runner(command_time, spawn),
+        periodic_jobs=False)
+
+    bot = threading.Thread(target=slack_client.run)
+    bot.daemon = True
+    bot.start()
+
+    user_ids = slack.user_ids
+    started_at = time.time()
+    sequence = 0
+    while time.time() - started_at < duration:
+        with lock:
+            sent_at[sequence] = time.time()
+        slack.send_message(
+            random.choice(user_ids), _MESSAGE_TEXT.format(sequence))
+        sequence += 1
+
+        # Keep the rate even if sending fell behind
+        time.sleep(max(started_at + sequence / rate - time.time(), 0))
+
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        with lock:
+            if len(answered_at) == len(sent_at):
+                break
+        time.sleep(0.1)
+
+    with lock:
+        latencies = sorted(
+            answered_at[sequence] - sent_at[sequence]
+            for sequence in answered_at)
+
+    return {
+        'sent': len(sent_at),
+        'answered': len(latencies),
+        'dropped': len(sent_at) - len(latencies),
+        'latencies': latencies,
+        'api_calls': dict(slack.call_counts),
+    }
+
+
+@click.command()
+@click.option('--users', type=click.INT, default=50,
+              help='Members of the fake workspace')
+@click.option('--rate', type=click.FLOAT, default=1.0,
+              help='Messages sent to the bot per second')
+@click.option('--duration', type=click.INT, default=30,
+              help='Seconds to keep sending messages for')
+@click.option('--timeout', type=click.INT, default=30,
+              help='Seconds to wait for the last answers')
+@click.option('--command-time', type=click.FLOAT, default=0.0,
+              help='Seconds every gym_sub command takes')
+@click.option('--spawn/--no-spawn', default=False,
+              help='Start a real gym_sub process for every message')
+@click.option('--api-latency', type=click.FLOAT, default=0.0,
+              help='Seconds every Slack Web API call takes')
+def main(users, rate, duration, timeout, command_time, spawn, api_latency):
+    result = run_load_test(
+        users, rate, duration, timeout, command_time=command_time,
+        spawn=spawn, api_latency=api_latency)
+
+    click.echo('Sent {sent}, answered {answered}, dropped {dropped}'.format(
+        **result))
+
+    latencies = result['latencies']
+    if latencies:
+        click.echo('Latency p50 {:.3f}s, p90 {:.3f}s, p99 {:.3f}s, '
+                   'max {:.3f}s'.format(
+                       _percentile(latencies, 50),
+                       _percentile(latencies, 90),
+                       _percentile(latencies, 99),
+                       latencies[-1]))
+
+    for method, count in sorted(result['api_calls'].items()):
+        click.echo('{} {} calls'.format(method, count))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+'''
+A local service that owns the public timetable so it is scraped once for
+everybody instead of once per user and command.
+
+The service refreshes the timetable every TIMETABLE_REFRESH_INTERVAL seconds
+and serves the classes that can currently be scheduled as JSON
+(/timetable.json) and as an iCal feed (/timetable.ics). Schedulers use
+TimetableClient to look up the url of an activity and only need a browser
+for the login and the click.
+'''
+import json
+import time
+import socket
+import urllib2
+import logging
+import datetime
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+import settings
+from activities import Activity
+
+
+class TimetableUnavailableError(Exception):
+    pass
+
+
+def _serialize_timetable(activities):
+    entries = []
+    for activity, urls in sorted(
+            activities.items(), key=lambda item: item[0].date_time):
+        entry = activity.to_dict()
+        entry['urls'] = urls
+        entries.append(entry)
+
+    return entries
+
+
+def _format_ical_date_time(value):
+    return value.strftime('%Y%m%dT%H%M%S')
+
+
+def _escape_ical_text(text):
+    return (text.replace('\\', '\\\\').replace(';', '\\;')
+            .replace(',', '\\,').replace('\n', '\\n'))
+
+
+def make_ical(activities, generated_at):
+    stamp = _format_ical_date_time(
+        datetime.datetime.utcfromtimestamp(generated_at)) + 'Z'
+
+    lines = [
+        'BEGIN:VCALENDAR',
+        'VERSION:2.0',
+        'PRODID:-//gym_sub//timetable//EN',
+    ]
+    for activity, urls in sorted(
+            activities.items(), key=lambda item: item[0].date_time):
+        start = _format_ical_date_time(activity.date_time)
+        lines.extend([
+            'BEGIN:VEVENT',
+            'UID:{}-{}@gym_sub'.format(start, activity.name.lower()),
+            'DTSTAMP:{}'.format(stamp),
+            'DTSTART:{}'.format(start),
+            'SUMMARY:{}'.format(_escape_ical_text(activity.name)),
+            'URL:{}'.format(urls[0]),
+            'END:VEVENT',
+        ])
+    lines.append('END:VCALENDAR')
+
+    return '\r\n'.join(lines) + '\r\n'
+
+
+class TimetableService(object):
+
+    def __init__(self, refresh_interval=None):
+        self._refresh_interval = (
+            refresh_interval or settings.TIMETABLE_REFRESH_INTERVAL)
+        self._lock = threading.Lock()
+        self._activities = {}
+        self._refreshed_at = None
+        self._changes = {'added': [], 'removed': []}
+
+    def refresh(self):
+        from scheduler import CrossfitScheduler
+
+        # The timetable is public, no need for a real email
+        with CrossfitScheduler('') as scheduler:
+            activities = scheduler.get_timetable()
+
+        with self._lock:
+            previous = set(self._activities)
+            current = set(activities)
+            self._changes = {
+                'added': [activity.to_dict()
+                          for activity in current - previous],
+                'removed': [activity.to_dict()
+                            for activity in previous - current],
+            }
+            self._activities = activities
+            self._refreshed_at = time.time()
+
+        logging.info('Timetable refreshed, {} added and {} removed'.format(
+            len(self._changes['added']), len(self._changes['removed'])))
+
+    def _refresh_forever(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception, e:
+                # Keep serving what we have, the client knows how old it is
+                logging.error('Could not refresh timetable: {}'.format(e))
+
+            time.sleep(self._refresh_interval)
+
+    def get_json(self):
+        with self._lock:
+            return json.dumps({
+                'refreshed_at': self._refreshed_at,
+                'refresh_interval': self._refresh_interval,
+                'activities': _serialize_timetable(self._activities),
+                'changes': self._changes,
+            })
+
+    def get_ical(self):
+        with self._lock:
+            return make_ical(self._activities, self._refreshed_at or 0)
+
+    def serve_forever(self, port, host='127.0.0.1'):
+        service = self
+
+        class TimetableHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path == '/timetable.json':
+                    body, content_type = service.get_json(), 'application/json'
+                elif self.path == '/timetable.ics':
+                    body, content_type = service.get_ical(), 'text/calendar'
+                else:
+                    self.send_error(404)
+                    return
+
+                # Class names scraped from the site are unicode
+                if isinstance(body, unicode):
+                    body = body.encode('utf-8')
+
+                self.send_response(200)
+                self.send_header(
+                    'Content-Type', '{}; charset=utf-8'.format(content_type))
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        refresher = threading.Thread(target=self._refresh_forever)
+        refresher.daemon = True
+        refresher.start()
+
+        logging.info('Serving timetable on {}:{}'.format(host, port))
+        HTTPServer((host, port), TimetableHandler).serve_forever()
+
+
+class TimetableClient(object):
+    '''
+    Looks activities up in a running TimetableService
+    '''
+
+    # In seconds
+    _TIMEOUT = 5
+
+    def __init__(self, url):
+        self._url = url.rstrip('/')
+
+    def _fetch(self):
+        try:
+            response = urllib2.urlopen(
+                self._url + '/timetable.json', timeout=self._TIMEOUT)
+            data = json.load(response)
+        except (urllib2.URLError, socket.error, ValueError), e:
+            raise TimetableUnavailableError(
+                'Could not reach the timetable service: {}'.format(e))
+
+        if data['refreshed_at'] is None:
+            raise TimetableUnavailableError('The timetable is not loaded yet')
+
+        # Missing a refresh is fine, missing two means it is not working
+        if time.time() - data['refreshed_at'] > 2 * data['refresh_interval']:
+            raise TimetableUnavailableError('The timetable is out of date')
+
+        return data
+
+    def get_timetable(self):
+        '''
+        Return a dictionary mapping every Activity that can be scheduled to
+        the urls for scheduling it
+        '''
+        return dict(
+            (Activity.from_dict(entry), entry['urls'])
+            for entry in self._fetch()['activities']
+        )
+
+    def lookup(self, activity):
+        '''
+        Return the urls for scheduling the activity or None if it cannot be
+        scheduled
+        '''
+        return self.get_timetable().get(activity)